@@ -0,0 +1,166 @@
+import streamlit as st
+import hmac
+import time
+import pandas as pd
+from utils import get_login_limiter, get_session_index
+import config
+
+
+# Admin dashboard of a study wave, started with `streamlit run admin.py`: live, abandoned
+# and completed sessions, closing codes, turns per section, durations and per-turn
+# latency, all queried from the session index (see index.py) which the interview app
+# updates with every save
+
+# Seconds between automatic refreshes of the dashboard
+REFRESH_INTERVAL = 10
+
+# Windows for the per-turn latency
+LATENCY_WINDOWS = {"Last hour": 3600, "Last day": 24 * 3600, "Last week": 7 * 24 * 3600}
+
+
+st.set_page_config(
+    page_title="Interviews admin", page_icon=config.AVATAR_INTERVIEWER, layout="wide"
+)
+
+if not config.INDEX_DATABASE:
+    st.error("The session index is disabled (INDEX_DATABASE in config.py).")
+    st.stop()
+
+
+# Placeholder of the admin password in the template of secrets.toml
+PLACEHOLDER_PASSWORD = "addpasswordhere"
+
+admin_password = st.secrets.get("ADMIN_PASSWORD")
+if not admin_password or admin_password == PLACEHOLDER_PASSWORD:
+    st.error(
+        "The admin dashboard is disabled until ADMIN_PASSWORD is set to a password of "
+        "your own in secrets.toml."
+    )
+    st.stop()
+
+
+# Password of ADMIN_PASSWORD in secrets.toml (failed attempts are rate limited)
+if not st.session_state.get("admin", False):
+    with st.form("Admin"):
+        password = st.text_input("Admin password", type="password")
+        submitted = st.form_submit_button("Log in")
+    if not submitted:
+        st.stop()
+    limiter = get_login_limiter()
+    if limiter.blocked("admin"):
+        st.error("Too many failed logins, please try again later")
+        st.stop()
+    if not hmac.compare_digest(password, admin_password):
+        limiter.record_failure("admin")
+        st.error("Password incorrect")
+        st.stop()
+    limiter.reset("admin")
+    st.session_state.admin = True
+    st.rerun()
+
+
+index = get_session_index()
+studies = index.studies()
+if not studies:
+    st.markdown("No sessions yet.")
+    st.stop()
+
+col1, col2 = st.columns(2)
+with col1:
+    study = st.selectbox("Study", studies)
+with col2:
+    latency_window = st.selectbox("Per-turn latency", list(LATENCY_WINDOWS))
+
+
+@st.fragment(run_every=REFRESH_INTERVAL)
+def overview():
+
+    # Sessions by status
+    counts = index.status_counts(study, config.ADMIN_ABANDONED_AFTER)
+    for column, (status, count) in zip(st.columns(3), counts.items()):
+        column.metric(status.capitalize(), count)
+
+    col1, col2, col3 = st.columns(3)
+
+    # Closing codes of completed sessions (quit button without code)
+    with col1:
+        st.subheader("Endings")
+        codes = {
+            code if code is not None else "quit": count
+            for code, count in index.code_counts(study).items()
+        }
+        if codes:
+            st.bar_chart(pd.Series(codes, name="sessions"))
+
+    # Interviewer turns by section of the interview
+    with col2:
+        st.subheader("Turns per section")
+        sections = {
+            section or "-": count for section, count in index.section_turns(study).items()
+        }
+        if sections:
+            st.bar_chart(pd.Series(sections, name="turns"))
+
+    # Durations of completed sessions
+    with col3:
+        st.subheader("Duration (minutes)")
+        durations = index.duration_histogram(study)
+        if durations:
+            st.bar_chart(pd.Series(durations, name="sessions"))
+
+    # Latency by turn of the interview
+    st.subheader("Per-turn latency (seconds)")
+    turns = pd.DataFrame(
+        index.recent_turns(study, time.time() - LATENCY_WINDOWS[latency_window]),
+        columns=[
+            "turn",
+            "section",
+            "time_to_first_token",
+            "stream_seconds",
+            "rerun_seconds",
+            "output_tokens",
+            "time",
+        ],
+    )
+    if turns.empty:
+        st.markdown("No turns in this window.")
+    else:
+        latency = turns.groupby("turn")[["time_to_first_token", "rerun_seconds"]]
+        col1, col2 = st.columns(2)
+        with col1:
+            st.line_chart(latency.quantile(0.5).add_suffix(" p50"))
+        with col2:
+            st.line_chart(latency.quantile(0.9).add_suffix(" p90"))
+        st.dataframe(
+            turns[["time_to_first_token", "stream_seconds", "rerun_seconds"]]
+            .quantile([0.5, 0.9, 0.99])
+            .rename(index=lambda q: f"p{round(q * 100)}")
+        )
+
+    # Most recently saved sessions
+    st.subheader("Recent sessions")
+    sessions = pd.DataFrame(
+        index.recent_sessions(study),
+        columns=[
+            "username",
+            "session_id",
+            "status",
+            "start_time",
+            "last_save",
+            "end_time",
+            "messages",
+            "section",
+            "code",
+            "model",
+        ],
+    )
+    abandoned = (sessions["status"] == "active") & (
+        sessions["last_save"] < time.time() - config.ADMIN_ABANDONED_AFTER
+    )
+    sessions.loc[abandoned, "status"] = "abandoned"
+    for column in ("start_time", "last_save", "end_time"):
+        sessions[column] = pd.to_datetime(sessions[column], unit="s")
+    st.dataframe(sessions, hide_index=True)
+
+
+overview()
@@ -0,0 +1,298 @@
+import os
+import csv
+import hmac
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from functools import lru_cache
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from storage import SQLiteDatabase
+
+
+logger = logging.getLogger(__name__)
+
+
+# Credentials of the login screen in an indexed SQLite database instead of secrets.toml:
+# passwords are stored as salted scrypt hashes and looked up by username (no respondent
+# list is loaded at startup), e.g. `python auth.py import respondents.csv`
+# Successful verifications are cached in memory (scrypt is slow on purpose) and failed
+# logins of a username are rate limited.
+
+
+# scrypt parameters of new hashes (stored with each hash, so they can be raised later)
+SCRYPT_N = 2**14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+
+
+def hash_password(password, salt=None):
+    """Salted scrypt hash of a password as `scrypt$n$r$p$salt$hash`."""
+
+    salt = salt or os.urandom(SALT_BYTES)
+    digest = hashlib.scrypt(
+        password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P
+    )
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+
+def verify_hash(password, encoded):
+    """Check a password against a hash of hash_password (in constant time)."""
+
+    try:
+        method, n, r, p, salt, digest = encoded.split("$")
+        if method != "scrypt":
+            return False
+        computed = hashlib.scrypt(
+            password.encode(),
+            salt=bytes.fromhex(salt),
+            n=int(n),
+            r=int(r),
+            p=int(p),
+        )
+    except ValueError:
+        logger.warning("Invalid password hash")
+        return False
+    return hmac.compare_digest(computed, bytes.fromhex(digest))
+
+
+class VerificationCache:
+    """Recently verified passwords, so that a respondent's reloads and repeated logins do
+    not run scrypt again. Entries are keyed by the stored hash (a changed password is not
+    found) and hold a keyed digest of the password, never the password itself."""
+
+    def __init__(self, size=10000, ttl=15 * 60):
+        self.size = size
+        self.ttl = ttl
+        self.key = os.urandom(32)
+        # Stored hash -> (digest of the verified password, time of verification)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def digest(self, password):
+        return hmac.new(self.key, password.encode(), hashlib.sha256).digest()
+
+    def check(self, encoded, password):
+        with self.lock:
+            entry = self.entries.get(encoded)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                return False
+            self.entries.move_to_end(encoded)
+        return hmac.compare_digest(entry[0], self.digest(password))
+
+    def add(self, encoded, password):
+        digest = self.digest(password)
+        with self.lock:
+            self.entries[encoded] = (digest, time.monotonic())
+            self.entries.move_to_end(encoded)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class LoginRateLimiter:
+    """Allows at most `attempts` failed logins of a username within `window` seconds.
+
+    Once `total_attempts` logins of all usernames together failed within the window (e.g.
+    guessing many usernames), the limiter is `saturated` and unknown usernames are
+    rejected without the scrypt hash which otherwise hides that they are unknown; known
+    usernames are still verified as long as they are under their own limit.
+
+    The limits hold per process: with several workers, a username can fail `attempts`
+    times on each worker. At most `max_usernames` usernames are tracked; the ones with the
+    oldest failures are dropped first.
+    """
+
+    def __init__(
+        self, attempts=5, window=15 * 60, total_attempts=1000, max_usernames=10000
+    ):
+        self.attempts = attempts
+        self.window = window
+        self.max_usernames = max_usernames
+        # Username -> times of failed logins within the window, least recent failure first
+        self.failures = OrderedDict()
+        # Times of the most recent failed logins of all usernames
+        self.all_failures = deque(maxlen=total_attempts)
+        self.lock = threading.Lock()
+
+    def recent(self, username, now):
+        failures = self.failures.get(username)
+        if failures is None:
+            return None
+        while failures and now - failures[0] > self.window:
+            failures.popleft()
+        if not failures:
+            del self.failures[username]
+            return None
+        return failures
+
+    def prune(self, now):
+        """Drop usernames without failures in the window, and the least recent ones
+        beyond `max_usernames`."""
+
+        while self.failures:
+            username, failures = next(iter(self.failures.items()))
+            if (
+                now - failures[-1] <= self.window
+                and len(self.failures) <= self.max_usernames
+            ):
+                break
+            del self.failures[username]
+
+    def blocked(self, username):
+        with self.lock:
+            failures = self.recent(username, time.monotonic())
+            return failures is not None and len(failures) >= self.attempts
+
+    def saturated(self):
+        with self.lock:
+            return (
+                len(self.all_failures) == self.all_failures.maxlen
+                and time.monotonic() - self.all_failures[0] <= self.window
+            )
+
+    def record_failure(self, username):
+        with self.lock:
+            now = time.monotonic()
+            failures = self.recent(username, now)
+            if failures is None:
+                failures = self.failures[username] = deque(maxlen=self.attempts)
+            failures.append(now)
+            self.failures.move_to_end(username)
+            self.all_failures.append(now)
+            self.prune(now)
+
+    def reset(self, username):
+        with self.lock:
+            self.failures.pop(username, None)
+
+
+class CredentialStore(SQLiteDatabase):
+    """Usernames and password hashes in SQLite; each login is one primary key lookup."""
+
+    def __init__(self, path, cache=None):
+        super().__init__(path)
+        self.cache = cache if cache is not None else VerificationCache()
+        self.connection().execute(
+            """CREATE TABLE IF NOT EXISTS credentials (
+                username TEXT PRIMARY KEY,
+                hash TEXT NOT NULL
+            ) WITHOUT ROWID"""
+        )
+
+    def lookup(self, username):
+        row = (
+            self.connection()
+            .execute("SELECT hash FROM credentials WHERE username = ?", (username,))
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def verify(self, username, password, hash_unknown=True):
+        encoded = self.lookup(username)
+        if encoded is None:
+            # Hash anyway, so unknown usernames take as long as wrong passwords (unless
+            # many logins failed, see LoginRateLimiter.saturated)
+            if hash_unknown:
+                verify_hash(password, dummy_hash())
+            return False
+        if self.cache.check(encoded, password):
+            return True
+        if verify_hash(password, encoded):
+            self.cache.add(encoded, password)
+            return True
+        return False
+
+    def add(self, credentials):
+        """Insert or replace (username, hash) pairs in one transaction."""
+
+        with self.connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO credentials VALUES (?, ?)", credentials
+            )
+
+    def remove(self, usernames):
+        with self.connection() as connection:
+            connection.executemany(
+                "DELETE FROM credentials WHERE username = ?",
+                [(username,) for username in usernames],
+            )
+
+    def count(self):
+        return self.connection().execute("SELECT COUNT(*) FROM credentials").fetchone()[0]
+
+
+@lru_cache(maxsize=None)
+def dummy_hash():
+    return hash_password("", salt=b"\0" * SALT_BYTES)
+
+
+def hash_row(row):
+    username, password = row
+    return username, hash_password(password)
+
+
+def read_respondents(path):
+    """Usernames and passwords of a CSV file with the columns `username` and `password`."""
+
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f)
+        missing = {"username", "password"} - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"{path} is missing the columns {', '.join(sorted(missing))}")
+        for row in reader:
+            if row["username"]:
+                yield row["username"].strip(), row["password"]
+
+
+def import_respondents(store, rows, workers=None, batch_size=1000):
+    """Hash the passwords of (username, password) rows in a process pool and insert them
+    in batches; returns the number of imported respondents."""
+
+    count = 0
+    batch = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for credential in executor.map(hash_row, rows, chunksize=64):
+            batch.append(credential)
+            if len(batch) >= batch_size:
+                store.add(batch)
+                count += len(batch)
+                batch = []
+    if batch:
+        store.add(batch)
+        count += len(batch)
+    return count
+
+
+if __name__ == "__main__":
+
+    import config
+
+    # Bulk management of respondents, e.g. `python auth.py import respondents.csv`
+    parser = argparse.ArgumentParser(description="Manage the credentials of respondents.")
+    parser.add_argument(
+        "--database", default=config.CREDENTIALS_DATABASE, help="Credentials database."
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser(
+        "import", help="Import (or update) respondents from a CSV with username,password."
+    )
+    import_parser.add_argument("csv")
+    import_parser.add_argument("--workers", type=int, help="Processes (default: CPU count).")
+    remove_parser = subparsers.add_parser("remove", help="Remove respondents.")
+    remove_parser.add_argument("usernames", nargs="+")
+    subparsers.add_parser("count", help="Number of respondents.")
+    args = parser.parse_args()
+
+    store = CredentialStore(args.database)
+    if args.command == "import":
+        start = time.perf_counter()
+        n = import_respondents(store, read_respondents(args.csv), workers=args.workers)
+        print(f"Imported {n} respondents in {time.perf_counter() - start:.1f}s")
+    elif args.command == "remove":
+        store.remove(args.usernames)
+        print(f"Removed {len(args.usernames)} respondents")
+    elif args.command == "count":
+        print(store.count())
@@ -0,0 +1,448 @@
+import os
+import json
+import time
+import shutil
+import socket
+import asyncio
+import resource
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import urllib.request
+from mock_provider import MockProvider, start_mock_provider
+import config
+
+
+# Load test of one worker: a `streamlit run interview.py` server in a separate process
+# serves simulated respondents which connect concurrently over Streamlit's websocket
+# protocol (like browsers), against the local mock provider, e.g.
+# `python benchmark.py --sessions 20 --turns 10 --output ../data/benchmark.json`
+# All sessions share the event loop, API client, scheduler and session registry of the
+# worker, so the report shows what one worker sustains: latencies seen by respondents,
+# CPU, memory and disk writes of the worker, and the load on its scheduler
+
+
+ANSWER = "I chose it mostly because of a teacher at school who made the subject come alive, and later because the job prospects looked good."
+
+# Seconds between two status reports of the worker
+STATUS_INTERVAL = 0.2
+
+
+def percentiles(values):
+    """Mean and percentiles of a list of values."""
+
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+    return {
+        "mean": sum(values) / len(values),
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p99": percentile(99),
+        "max": values[-1],
+    }
+
+
+def directory_size(directory):
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+def process_bytes_written():
+    """Bytes written to storage by this process (Linux only, otherwise None)."""
+
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def configure(settings):
+    """Point the app at the mock provider and at the benchmark directories."""
+
+    os.environ["OPENAI_BASE_URL"] = f"{settings['url']}/v1"
+    os.environ["ANTHROPIC_BASE_URL"] = settings["url"]
+    config.MODEL = "gpt-4o-mock" if settings["api"] == "openai" else "claude-mock"
+    config.RATE_LIMITS = {}
+    config.LOGINS = True
+    config.STORAGE_BACKEND = settings["storage_backend"]
+    config.TRANSCRIPTS_DIRECTORY = os.path.join(settings["directory"], "transcripts")
+    config.TIMES_DIRECTORY = os.path.join(settings["directory"], "times")
+    config.BACKUPS_DIRECTORY = os.path.join(settings["directory"], "backups")
+    config.SQLITE_DATABASE = os.path.join(settings["directory"], "interviews.db")
+    config.LOCKS_DIRECTORY = os.path.join(settings["directory"], "locks")
+    config.INDEX_DATABASE = os.path.join(settings["directory"], "index.db")
+
+
+def report_status(path):
+    """Write the resource usage of the worker, its scheduler and its sessions to a file
+    every STATUS_INTERVAL seconds (with the peaks since start)."""
+
+    from resources import connection_stats, get_scheduler
+    from session import get_session_registry
+    from storage import write_atomic
+
+    bytes_written_start = process_bytes_written()
+    peaks = {"queued": 0, "in_flight": 0, "resident_bytes": 0, "sessions": 0}
+    while True:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        scheduler = get_scheduler().metrics()
+        sessions = get_session_registry().report()
+        for name, value in (*scheduler.items(), *sessions.items()):
+            if name in peaks:
+                peaks[name] = max(peaks[name], value)
+        bytes_written = process_bytes_written()
+        status = {
+            "cpu_seconds": usage.ru_utime + usage.ru_stime,
+            "max_rss_bytes": usage.ru_maxrss * 1024,
+            "bytes_written": (
+                bytes_written - bytes_written_start if bytes_written is not None else None
+            ),
+            "scheduler": scheduler,
+            "connections": connection_stats.summary(),
+            "sessions": sessions,
+            "peaks": peaks,
+        }
+        write_atomic(path, json.dumps(status))
+        time.sleep(STATUS_INTERVAL)
+
+
+def serve(settings):
+    """Run the app as one Streamlit worker (in a separate process)."""
+
+    from streamlit.web import bootstrap
+
+    configure(settings)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    secrets = os.path.join(settings["directory"], "secrets.toml")
+    with open(secrets, "w") as f:
+        f.write('API_KEY_OPENAI = "mock"\nAPI_KEY_ANTHROPIC = "mock"\n[passwords]\n')
+        for index in range(settings["sessions"]):
+            f.write(f'benchmark{index} = "benchmark"\n')
+
+    threading.Thread(
+        target=report_status, args=(settings["status"],), daemon=True
+    ).start()
+
+    flag_options = {
+        "server_port": settings["port"],
+        "server_address": "127.0.0.1",
+        "server_headless": True,
+        "server_fileWatcherType": "none",
+        "secrets_files": [secrets],
+        "browser_gatherUsageStats": False,
+    }
+    bootstrap.load_config_options(flag_options)
+    bootstrap.run(os.path.join(directory, "interview.py"), False, [], flag_options)
+
+
+class Respondent:
+    """Simulated respondent: a Streamlit client which sets widget values and reruns the
+    script over the websocket, like a browser."""
+
+    def __init__(self, url):
+        self.url = url
+        self.websocket = None
+        self.widgets = {}
+        self.texts = []
+
+    async def connect(self):
+        from tornado.websocket import websocket_connect
+
+        self.websocket = await websocket_connect(self.url)
+
+    async def rerun(self, widget_states=()):
+        """Rerun the script with widget values; collects the widget ids and the markdown
+        texts of the run."""
+
+        from streamlit.proto.BackMsg_pb2 import BackMsg
+        from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+        message = BackMsg()
+        message.rerun_script.query_string = ""
+        message.rerun_script.widget_states.widgets.extend(widget_states)
+        await self.websocket.write_message(message.SerializeToString(), binary=True)
+
+        self.widgets, self.texts = {}, []
+        while True:
+            data = await self.websocket.read_message()
+            if data is None:
+                raise RuntimeError("Connection to the app closed")
+            forward = ForwardMsg()
+            forward.ParseFromString(data)
+            kind = forward.WhichOneof("type")
+            if kind == "script_finished":
+                return
+            if kind == "delta" and forward.delta.WhichOneof("type") == "new_element":
+                element = forward.delta.new_element
+                element_type = element.WhichOneof("type")
+                if element_type == "text_input":
+                    # Widget ids end with the key of the widget
+                    key = element.text_input.id.rsplit("-", 1)[-1]
+                    self.widgets[key] = element.text_input.id
+                elif element_type == "button" and element.button.is_form_submitter:
+                    self.widgets["submit"] = element.button.id
+                elif element_type == "chat_input":
+                    self.widgets["chat_input"] = element.chat_input.id
+                elif element_type == "markdown":
+                    self.texts.append(element.markdown.body)
+                elif element_type == "exception":
+                    raise RuntimeError(element.exception.message)
+
+    async def login(self, username, password):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        await self.rerun(
+            [
+                WidgetState(id=self.widgets["username"], string_value=username),
+                WidgetState(id=self.widgets["password"], string_value=password),
+                WidgetState(id=self.widgets["submit"], trigger_value=True),
+            ]
+        )
+
+    async def answer(self, text):
+        from streamlit.proto.WidgetStates_pb2 import WidgetState
+
+        state = WidgetState(id=self.widgets["chat_input"])
+        state.string_trigger_value.data = text
+        await self.rerun([state])
+
+    async def close(self):
+        self.websocket.close()
+
+
+async def run_session(index, url, settings):
+    """Run one interview as simulated respondent; returns its measurements."""
+
+    respondent = Respondent(url)
+    await respondent.connect()
+    await respondent.rerun()
+
+    # The run after the login generates (or shows the prefetched) opening message
+    start = time.perf_counter()
+    await respondent.login(f"benchmark{index}", "benchmark")
+    opening_latency = time.perf_counter() - start
+
+    turn_latencies = []
+    for turn in range(settings["turns"] + 1):
+        answer = ANSWER if turn < settings["turns"] else settings["end_phrase"]
+        start = time.perf_counter()
+        await respondent.answer(answer)
+        turn_latencies.append(time.perf_counter() - start)
+
+    completed = config.CLOSING_MESSAGES[settings["end_code"]] in respondent.texts
+    await respondent.close()
+    return {
+        "opening_latency": opening_latency,
+        "turn_latencies": turn_latencies,
+        "completed": completed,
+    }
+
+
+def wait_for_worker(port, process, timeout):
+    """Wait until the health endpoint of the worker answers."""
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not process.is_alive():
+            raise RuntimeError("The worker stopped during startup")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health") as r:
+                if r.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("The worker did not start")
+
+
+def read_status(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_turn_metrics(directory):
+    """Metrics of all turns as recorded by the worker (from its session index)."""
+
+    from index import SessionIndex
+
+    return SessionIndex(os.path.join(directory, "index.db")).recent_turns(
+        "default", 0, limit=-1
+    )
+
+
+async def run_sessions(sessions, url, settings):
+    return await asyncio.gather(
+        *(run_session(index, url, settings) for index in range(sessions))
+    )
+
+
+def run_benchmark(
+    sessions=10,
+    turns=5,
+    api="openai",
+    first_token_latency=0.3,
+    tokens_per_second=50.0,
+    reply_tokens=40,
+    storage_backend="files",
+    error_rate=0.0,
+    retry_after=None,
+    timeout=120,
+):
+    """Run the benchmark and return the report as dictionary."""
+
+    provider = MockProvider(
+        first_token_latency,
+        tokens_per_second,
+        reply_tokens,
+        error_rate=error_rate,
+        retry_after=retry_after,
+    )
+    server, url = start_mock_provider(provider)
+    data_directory = tempfile.mkdtemp(prefix="interview_benchmark_")
+    port = free_port()
+    settings = {
+        "url": url,
+        "api": api,
+        "storage_backend": storage_backend,
+        "directory": data_directory,
+        "sessions": sessions,
+        "turns": turns,
+        "end_phrase": provider.end_phrase,
+        "end_code": provider.end_code,
+        "port": port,
+        "status": os.path.join(data_directory, "status.json"),
+    }
+
+    worker = multiprocessing.get_context("spawn").Process(target=serve, args=(settings,))
+    worker.start()
+    try:
+        wait_for_worker(port, worker, timeout)
+        status_start = read_status(settings["status"])
+
+        start = time.perf_counter()
+        results = asyncio.run(
+            asyncio.wait_for(
+                run_sessions(sessions, f"ws://127.0.0.1:{port}/_stcore/stream", settings),
+                timeout,
+            )
+        )
+        wall_time = time.perf_counter() - start
+
+        # Last status of the worker after all sessions
+        time.sleep(2 * STATUS_INTERVAL)
+        status = read_status(settings["status"])
+        turn_metrics = read_turn_metrics(data_directory)
+        stored_bytes = directory_size(data_directory) - os.path.getsize(settings["status"])
+
+    finally:
+        worker.terminate()
+        worker.join()
+        server.shutdown()
+        shutil.rmtree(data_directory, ignore_errors=True)
+
+    # CPU and disk writes of the worker while serving the sessions (without startup)
+    cpu_seconds = status["cpu_seconds"] - status_start["cpu_seconds"]
+    bytes_written = (
+        status["bytes_written"] - status_start["bytes_written"]
+        if status["bytes_written"] is not None
+        else None
+    )
+
+    # Columns of the turns in the session index
+    time_to_first_token = [row[2] for row in turn_metrics if row[2] is not None]
+    rerun_seconds = [row[4] for row in turn_metrics if row[4] is not None]
+    return {
+        "settings": {
+            "sessions": sessions,
+            "turns": turns,
+            "api": api,
+            "first_token_latency": first_token_latency,
+            "tokens_per_second": tokens_per_second,
+            "reply_tokens": reply_tokens,
+            "storage_backend": storage_backend,
+            "error_rate": error_rate,
+        },
+        "completed_sessions": sum(result["completed"] for result in results),
+        "wall_time": wall_time,
+        "time_to_first_token": percentiles(time_to_first_token),
+        "rerun_seconds": percentiles(rerun_seconds),
+        "opening_message_latency": percentiles(
+            [result["opening_latency"] for result in results]
+        ),
+        "turn_latency": percentiles(
+            [latency for result in results for latency in result["turn_latencies"]]
+        ),
+        "worker": {
+            "cpu_seconds": cpu_seconds,
+            "cpu_seconds_per_interview": cpu_seconds / sessions,
+            "cpu_utilisation": cpu_seconds / wall_time,
+            "max_rss_bytes": status["max_rss_bytes"],
+            "peak_sessions": status["peaks"]["sessions"],
+            "peak_session_memory_bytes": status["peaks"]["resident_bytes"],
+            "disk_bytes_written_per_interview": (
+                bytes_written / sessions if bytes_written is not None else None
+            ),
+            "stored_bytes_per_interview": stored_bytes / sessions,
+        },
+        "scheduler": {
+            **status["scheduler"],
+            "peak_queued": status["peaks"]["queued"],
+            "peak_in_flight": status["peaks"]["in_flight"],
+        },
+        "connections": status["connections"],
+        "provider_requests": provider.requests,
+        "provider_errors": provider.errors,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load test of one worker of the app.")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--api", choices=["openai", "anthropic"], default="openai")
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--storage", choices=["files", "sqlite"], default="files")
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of API requests which fail."
+    )
+    parser.add_argument("--retry-after", type=float, help="retry-after header of errors.")
+    parser.add_argument("--output", help="File for the JSON report (default: print).")
+    args = parser.parse_args()
+
+    report = run_benchmark(
+        sessions=args.sessions,
+        turns=args.turns,
+        api=args.api,
+        first_token_latency=args.first_token_latency,
+        tokens_per_second=args.tokens_per_second,
+        reply_tokens=args.reply_tokens,
+        storage_backend=args.storage,
+        error_rate=args.error_rate,
+        retry_after=args.retry_after,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
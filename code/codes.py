@@ -0,0 +1,98 @@
+from collections import deque
+from functools import lru_cache
+
+
+class CodeAutomaton:
+    """Aho-Corasick automaton over the closing codes.
+
+    Each character of a message is processed once. The depth of the current state is
+    the length of the longest end of the text so far which could still become a code.
+    """
+
+    def __init__(self, codes):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [None]
+        self.depth = [0]
+
+        # Trie of all codes
+        for code in codes:
+            state = 0
+            for char in code:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(None)
+                    self.depth.append(self.depth[state] + 1)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.output[state] = code
+
+        # Failure links in breadth-first order; a state also matches the codes of its
+        # failure state (codes which are a suffix of another code)
+        states = deque(self.goto[0].values())
+        while states:
+            state = states.popleft()
+            for char, next_state in self.goto[state].items():
+                states.append(next_state)
+                self.fail[next_state] = self.step(self.fail[state], char)
+                if self.output[next_state] is None:
+                    self.output[next_state] = self.output[self.fail[next_state]]
+
+    def step(self, state, char):
+        while state and char not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(char, 0)
+
+    def find(self, text):
+        """Return the first code contained in a complete text, or None."""
+
+        state = 0
+        for char in text:
+            state = self.step(state, char)
+            if self.output[state] is not None:
+                return self.output[state]
+        return None
+
+
+@lru_cache(maxsize=None)
+def get_code_automaton(codes):
+    """Build the automaton once per process for a tuple of codes."""
+
+    return CodeAutomaton(codes)
+
+
+class CodeDetector:
+    """Detects closing codes in a streamed message, delta by delta.
+
+    `feed` returns the part of the text which is safe to display: only the end which
+    could still turn into a code is held back.
+    """
+
+    def __init__(self, automaton):
+        self.automaton = automaton
+        self.state = 0
+        self.held = ""
+        self.code = None
+
+    def feed(self, delta):
+        if self.code is not None:
+            return ""
+
+        for char in delta:
+            self.state = self.automaton.step(self.state, char)
+            if self.automaton.output[self.state] is not None:
+                self.code = self.automaton.output[self.state]
+                self.held = ""
+                return ""
+
+        text = self.held + delta
+        split = len(text) - self.automaton.depth[self.state]
+        self.held = text[split:]
+        return text[:split]
+
+    def flush(self):
+        """Return the held back text at the end of a message without code."""
+
+        held, self.held = self.held, ""
+        return held
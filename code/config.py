@@ -79,9 +79,77 @@ TEMPERATURE = None  # (None for default value)
 MAX_OUTPUT_TOKENS = 2048
 
 
+# Scheduling of API requests shared by all sessions of a worker process: rate limits per
+# model (None for no limit), maximum of concurrent requests, retries with jittered
+# exponential backoff (seconds), and an optional fallback model of the same API
+RATE_LIMITS = {MODEL: {"requests_per_minute": None, "tokens_per_minute": None}}
+MAX_CONCURRENT_REQUESTS = 50
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1.0
+FALLBACK_MODEL = None
+
+
+# Context management: if the history (without system prompt) exceeds this many estimated
+# tokens, earlier turns are replaced by a summary and only recent turns are sent (None to
+# always send the full history); prompt caching marks the system prompt and conversation
+# prefix for reuse with Anthropic models (OpenAI caches long prefixes automatically)
+CONTEXT_TOKEN_BUDGET = None
+PROMPT_CACHING = True
+
+
+# Generate the opening interviewer message of each study once in the background and show
+# it to new sessions immediately (regenerated when the study or model changes; all
+# respondents of a study version receive the same opening message)
+PREFETCH_OPENING_MESSAGE = True
+
+
+# Streaming display: repaint a message at most every STREAM_REPAINT_INTERVAL seconds and
+# only after at least STREAM_REPAINT_MIN_CHARS new characters
+STREAM_REPAINT_INTERVAL = 0.1
+STREAM_REPAINT_MIN_CHARS = 1
+
+
+# HTTP connection pool of the API client shared by all sessions of a worker process
+MAX_CONNECTIONS = 100
+KEEPALIVE_EXPIRY = 60  # seconds an idle connection is kept open for reuse
+
+
+# Instrumentation: sections of the interview with the start of the interviewer's first
+# question in each section (to label per-turn metrics), and optional export of per-turn
+# metrics to a local Prometheus endpoint on this port (requires prometheus_client) and to
+# an OTLP JSON file (requires opentelemetry-sdk); None to disable
+SECTIONS = {
+    "Part I": None,
+    "Part II": "Next, I would like to focus further on why or why not you pursued a STEM subject",
+    "Part III": "Lastly, I would like to shift the focus from education to occupation",
+    "Summary": "To conclude, how well does the summary of our discussion describe",
+}
+PROMETHEUS_PORT = None
+OTLP_METRICS_FILE = None
+
+
+# Directory of study files for serving several studies from one app (see studies.py);
+# the settings in this file are the default study and the defaults of all studies
+STUDIES_DIRECTORY = "../studies/"
+
+
 # Display login screen with usernames and simple passwords for studies
 LOGINS = False
 
+# Credentials of the login screen: "secrets" (usernames and passwords in the [passwords]
+# section of secrets.toml) or "sqlite" (salted password hashes in CREDENTIALS_DATABASE,
+# imported without a redeploy with `python auth.py import respondents.csv`)
+CREDENTIALS_BACKEND = "secrets"
+CREDENTIALS_DATABASE = "../data/credentials.db"
+
+# Failed logins of a username allowed within LOGIN_ATTEMPTS_WINDOW seconds, and failed
+# logins of all usernames together after which unknown usernames are rejected without
+# computing a password hash for the rest of the window (limits are per worker process, so
+# with N workers they are N times as high)
+LOGIN_ATTEMPTS = 5
+LOGIN_ATTEMPTS_WINDOW = 15 * 60
+LOGIN_ATTEMPTS_TOTAL = 1000
+
 
 # Directories
 TRANSCRIPTS_DIRECTORY = "../data/transcripts/"
@@ -89,6 +157,49 @@ TIMES_DIRECTORY = "../data/times/"
 BACKUPS_DIRECTORY = "../data/backups/"
 
 
+# Storage backend: "files" (transcripts, times and backups as files in the directories
+# above) or "sqlite" (all sessions and messages in one database, export to files with
+# `python storage.py export <directory>`)
+STORAGE_BACKEND = "files"
+SQLITE_DATABASE = "../data/interviews.db"
+
+
+# For the "files" backend: store backups as an append-only journal (one JSON line per
+# message, only new messages are written each turn) which is compacted into the final
+# transcript at the end, instead of rewriting the full backup files after every turn
+JOURNAL_BACKUPS = True
+
+
+# Attempts to store data (with short exponential backoff) before a final save is handed to
+# a background thread which keeps retrying
+SAVE_ATTEMPTS = 3
+
+
+# Resume the latest unfinished session of a username from storage on login (e.g. after a
+# restart or on another worker). Several workers can share one data directory or SQLite
+# database; the lock files in LOCKS_DIRECTORY (on the shared storage) make sure only the
+# newest session of a username stores data.
+RESUME_SESSIONS = True
+LOCKS_DIRECTORY = "../data/locks/"
+
+
+# Index of live and completed sessions for the admin dashboard (`streamlit run admin.py`),
+# updated with every save (None to disable); sessions without a save for
+# ADMIN_ABANDONED_AFTER seconds are shown as abandoned
+INDEX_DATABASE = "../data/index.db"
+ADMIN_ABANDONED_AFTER = 30 * 60
+
+
+# Session memory: only the most recent messages of a session are kept in memory, older
+# messages which are already stored are read back from the journal or database when needed
+# (None keeps all messages in memory; requires JOURNAL_BACKUPS or the "sqlite" backend).
+# Messages still sent to the API stay in memory (all of them unless CONTEXT_TOKEN_BUDGET
+# is set), and released messages are only shown to the respondent on request.
+# Sessions without activity for SESSION_IDLE_TIMEOUT seconds release all stored messages.
+SESSION_MESSAGE_WINDOW = 20
+SESSION_IDLE_TIMEOUT = 30 * 60
+
+
 # Avatars displayed in the chat interface
 AVATAR_INTERVIEWER = "\U0001F393"
 AVATAR_RESPONDENT = "\U0001F9D1\U0000200D\U0001F4BB"
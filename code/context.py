@@ -0,0 +1,202 @@
+import logging
+import config
+from resources import api_of_model, get_api_kwargs
+
+
+logger = logging.getLogger(__name__)
+
+
+# Instruction for condensing the earlier part of an interview once the history exceeds
+# the token budget
+SUMMARY_PROMPT = """Below is the earlier part of an interview (and possibly a summary of the part before it). Write a detailed summary of everything the respondent said so far, organised by the parts of the interview outline, so that the interview can be continued and summarised at the end without the original messages. Do not add commentary."""
+
+
+def count_tokens(text):
+    """Estimate the number of tokens of a text (around four characters per token)."""
+
+    return len(text) // 4 + 1
+
+
+def text_of(content):
+    """Text of a message content or system prompt (string or list of text blocks)."""
+
+    if isinstance(content, str):
+        return content
+    return "".join(block["text"] for block in content)
+
+
+def estimate_input_tokens(api_kwargs):
+    """Estimate the input tokens of a request from its API kwargs."""
+
+    tokens = sum(count_tokens(text_of(m["content"])) for m in api_kwargs["messages"])
+    if "system" in api_kwargs:
+        tokens += count_tokens(text_of(api_kwargs["system"]))
+    return tokens
+
+
+class ContextManager:
+    """Prepares the messages sent to the API for one session within a token budget.
+
+    Token counts of messages are cached and only new messages are counted. If the
+    history exceeds the budget, the oldest turns are replaced by a summary which is
+    added to the system prompt, and the recent turns are sent as a rolling window.
+    """
+
+    def __init__(self, api, budget=None, window=None, study=config):
+        self.api = api
+        # Study whose system prompt is sent (config.py by default)
+        self.study = study
+        self.budget = budget
+        # After summarising, keep recent messages up to this many tokens so that the
+        # summary is only updated again once the window has filled up
+        self.window = window if window is not None else (budget or 0) // 2
+        self.token_counts = []
+        self.summary = ""
+        self.summarized_upto = 0
+        self.usage = []
+
+    def history_start(self):
+        """Index of the first message sent as history (the OpenAI system message is
+        rebuilt in prepare and not part of the history)."""
+
+        return max(self.summarized_upto, 1 if self.api == "openai" else 0)
+
+    def first_needed(self):
+        """Index of the first message which `prepare` still reads; earlier messages can
+        be released from memory."""
+
+        return min(self.history_start(), len(self.token_counts))
+
+    def count(self, messages):
+        """Count tokens of messages not yet counted and return the total of the history."""
+
+        for message in messages[len(self.token_counts) :]:
+            self.token_counts.append(count_tokens(message["content"]))
+        return sum(self.token_counts[self.history_start() :]) + count_tokens(
+            self.summary
+        )
+
+    def prepare(self, api_kwargs, summarize=None):
+        """Return a copy of api_kwargs with the history fitted into the budget."""
+
+        messages = api_kwargs["messages"]
+        total = self.count(messages)
+        start = self.history_start()
+
+        # Replace oldest turns by a summary if the history exceeds the budget
+        if self.budget is not None and summarize is not None and total > self.budget:
+            cut = len(messages)
+            kept = 0
+            while cut - 1 > start and kept + self.token_counts[cut - 1] <= self.window:
+                kept += self.token_counts[cut - 1]
+                cut -= 1
+            # The latest message is always sent, even if it alone exceeds the window
+            cut = min(cut, len(messages) - 1)
+            # Window has to begin with a respondent message
+            while cut < len(messages) - 1 and messages[cut]["role"] != "user":
+                cut += 1
+            if cut > start:
+                self.summary = summarize(messages[start:cut], self.summary)
+                self.summarized_upto = cut
+                start = cut
+
+        # Only role and content are sent (messages can carry flags such as their code)
+        history = [
+            {"role": message["role"], "content": message["content"]}
+            for message in messages[start:]
+        ]
+        system = self.study.SYSTEM_PROMPT
+        if self.summary:
+            system += f"\n\n\nSummary of the interview so far:\n\n{self.summary}"
+
+        api_kwargs = dict(api_kwargs)
+        if self.api == "openai":
+            # OpenAI caches long stable prefixes automatically
+            api_kwargs["messages"] = [{"role": "system", "content": system}] + history
+
+        elif self.api == "anthropic" and config.PROMPT_CACHING:
+            # Cache breakpoints on the system prompt and the end of the conversation,
+            # so that the next turn reads the stable prefix from the prompt cache
+            api_kwargs["system"] = [
+                {"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}
+            ]
+            api_kwargs["messages"] = history[:-1] + [
+                {
+                    "role": history[-1]["role"],
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": history[-1]["content"],
+                            "cache_control": {"type": "ephemeral"},
+                        }
+                    ],
+                }
+            ]
+
+        elif self.api == "anthropic":
+            api_kwargs["system"] = system
+            api_kwargs["messages"] = history
+
+        return api_kwargs
+
+    def record_usage(self, input_tokens, output_tokens, cached_input_tokens=0):
+        """Store token usage reported by the API for one turn."""
+
+        self.usage.append(
+            {
+                "turn": len(self.usage) + 1,
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "cached_input_tokens": cached_input_tokens,
+            }
+        )
+        logger.info(
+            "Turn %d: %d input tokens (%d cached), %d output tokens",
+            len(self.usage),
+            input_tokens,
+            cached_input_tokens,
+            output_tokens,
+        )
+
+    def usage_totals(self):
+        """Total token usage of the session so far."""
+
+        return {
+            key: sum(turn[key] for turn in self.usage)
+            for key in ("input_tokens", "output_tokens", "cached_input_tokens")
+        }
+
+    def record_openai_usage(self, usage):
+        if usage is not None:
+            details = usage.prompt_tokens_details
+            self.record_usage(
+                usage.prompt_tokens,
+                usage.completion_tokens,
+                details.cached_tokens if details and details.cached_tokens else 0,
+            )
+
+    def record_anthropic_usage(self, usage):
+        if usage is not None:
+            self.record_usage(
+                usage.input_tokens,
+                usage.output_tokens,
+                usage.cache_read_input_tokens or 0,
+            )
+
+
+def summary_api_kwargs(messages, previous_summary, study=config):
+    """API kwargs of a request which summarises earlier messages of the interview."""
+
+    text = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    if previous_summary:
+        text = f"Summary of the part before:\n{previous_summary}\n\n{text}"
+
+    api_kwargs = get_api_kwargs([{"role": "user", "content": text}], study)
+    if api_of_model(study.MODEL) == "openai":
+        api_kwargs["messages"] = [
+            {"role": "system", "content": SUMMARY_PROMPT}
+        ] + api_kwargs["messages"]
+    elif api_of_model(study.MODEL) == "anthropic":
+        api_kwargs["system"] = SUMMARY_PROMPT
+
+    return api_kwargs
@@ -0,0 +1,448 @@
+import os
+import json
+import hashlib
+import logging
+import argparse
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+import config
+from storage import read_journal, write_atomic, SESSION_ID_FORMAT
+from studies import get_study_registry
+
+
+logger = logging.getLogger(__name__)
+
+
+# Export of the transcript, time and backup directories into one columnar table per study
+# (Parquet or Arrow) with one row per message, e.g.
+# `python export.py ../data/export/ --study pilot`
+# Files are parsed by a process pool into one part per file. A manifest with the mtime and
+# size of all files makes later exports parse only new or changed files.
+
+
+ROLES = ("system", "user", "assistant")
+
+# Messages of one parsed transcript or journal
+PART_SCHEMA = pa.schema(
+    [
+        ("position", pa.int32()),
+        ("role", pa.string()),
+        ("content", pa.string()),
+        ("time", pa.float64()),
+    ]
+)
+
+# Exported table: one row per message; status is "completed" (final transcript) or
+# "incomplete" (backup of a session without final transcript)
+SCHEMA = pa.schema(
+    [
+        ("study", pa.string()),
+        ("username", pa.string()),
+        ("session_id", pa.string()),
+        ("status", pa.string()),
+        ("start_time", pa.timestamp("s")),
+        ("duration_minutes", pa.float64()),
+        ("model", pa.string()),
+        ("position", pa.int32()),
+        ("role", pa.string()),
+        ("content", pa.string()),
+        ("time", pa.timestamp("ms")),
+    ]
+)
+
+# Rows buffered before they are written as one row group
+ROW_GROUP_SIZE = 50_000
+
+
+def parse_transcript(text):
+    """Parse a 'role: content' transcript. Lines which do not start with a role continue
+    the content of the previous message (multi-line answers)."""
+
+    lines = text.split("\n")
+    # Every message ends with a newline
+    if lines and lines[-1] == "":
+        lines.pop()
+
+    messages = []
+    for line in lines:
+        role, separator, content = line.partition(": ")
+        if separator and role in ROLES:
+            messages.append({"role": role, "content": content})
+        elif messages:
+            messages[-1]["content"] += "\n" + line
+    return messages
+
+
+def parse_time(text):
+    """Parse a time file into start time (seconds since the epoch) and duration."""
+
+    info = {}
+    for line in text.splitlines():
+        key, _, value = line.partition(": ")
+        if key == "Start time (UTC)":
+            info["start_time"] = datetime.datetime.strptime(
+                value.strip(), "%d/%m/%Y %H:%M:%S"
+            ).timestamp()
+        elif key == "Interview duration (minutes)":
+            info["duration_minutes"] = float(value)
+    return info
+
+
+def classify(directory, name):
+    """Kind, username and session id of a file in one of the data directories, or None
+    for files which are not interview data (e.g. temporary files)."""
+
+    if name.startswith("."):
+        return None
+
+    stem, extension = os.path.splitext(name)
+    if directory == "transcripts":
+        kinds = {".jsonl": "final_messages", ".txt": "final_transcript"}
+        return (kinds[extension], stem, None) if extension in kinds else None
+    if directory == "times":
+        kinds = {".json": "final_metadata", ".txt": "final_time"}
+        return (kinds[extension], stem, None) if extension in kinds else None
+
+    for marker, kind, file_extension in (
+        ("_journal_started_", "backup_messages", ".jsonl"),
+        ("_transcript_started_", "backup_transcript", ".txt"),
+        ("_time_started_", "backup_time", ".txt"),
+    ):
+        username, found, session_id = stem.rpartition(marker)
+        if found and extension == file_extension:
+            return kind, username, session_id
+    return None
+
+
+def write_part(path, messages):
+    """Store parsed messages as Arrow file (written atomically)."""
+
+    table = pa.Table.from_pylist(
+        [
+            {
+                "position": message.get("position", position),
+                "role": message["role"],
+                "content": message["content"],
+                "time": message.get("time"),
+            }
+            for position, message in enumerate(messages)
+        ],
+        schema=PART_SCHEMA,
+    )
+    temporary_path = f"{path}.tmp"
+    with pa.OSFile(temporary_path, "wb") as sink:
+        with pa.ipc.new_file(sink, PART_SCHEMA) as writer:
+            writer.write_table(table)
+    os.replace(temporary_path, path)
+
+
+def read_part(path):
+    with pa.memory_map(path) as source:
+        return pa.ipc.open_file(source).read_all().to_pylist()
+
+
+def parse_file(path, kind, part_path):
+    """Parse one data file (run in the process pool).
+
+    Messages are written to `part_path`; returns the small information kept in the
+    manifest (number of messages, times, model).
+    """
+
+    if kind in ("final_messages", "backup_messages"):
+        messages = read_journal(path)
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        if kind in ("final_time", "backup_time"):
+            return parse_time(text)
+        if kind == "final_metadata":
+            metadata = json.loads(text)
+            return {
+                "model": metadata.get("model"),
+                "session_id": metadata.get("session_id"),
+            }
+        messages = parse_transcript(text)
+
+    write_part(part_path, messages)
+    return {"messages": len(messages)}
+
+
+def scan(directories):
+    """Stream over the data directories; yields relative path, path and stat of files."""
+
+    for label, directory in directories.items():
+        if not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and classify(label, entry.name) is not None:
+                    yield f"{label}/{entry.name}", entry.path, entry.stat()
+
+
+def is_prefix(messages, final_messages):
+    """Check if a backup contains the beginning of a final transcript (the same session;
+    only for data stored before the session id was part of the final metadata)."""
+
+    return len(messages) <= len(final_messages) and all(
+        message["role"] == final["role"]
+        and message["content"].strip() == final["content"].strip()
+        for message, final in zip(messages, final_messages)
+    )
+
+
+def timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds) if seconds is not None else None
+
+
+def user_rows(study, username, files, parts_directory):
+    """Rows of all sessions of one user, with backups of the completed session removed."""
+
+    def messages_of(*kinds, session_id=None):
+        # Lossless JSONL files are preferred over parsed text transcripts
+        for kind in kinds:
+            for entry in files:
+                if entry["kind"] == kind and entry["session_id"] == session_id:
+                    return read_part(os.path.join(parts_directory, entry["part"]))
+        return None
+
+    def info_of(kind, session_id=None):
+        for entry in files:
+            if entry["kind"] == kind and entry["session_id"] == session_id:
+                return entry["info"]
+        return {}
+
+    sessions = []
+    final_messages = messages_of("final_messages", "final_transcript")
+    backup_ids = sorted(
+        {entry["session_id"] for entry in files if entry["session_id"] is not None}
+    )
+
+    # Session id of the final transcript (sessions can begin with the same prefetched
+    # opening message, so contents do not identify the session)
+    final_session_id = info_of("final_metadata").get("session_id")
+    final_times = {}
+    for session_id in backup_ids:
+        messages = messages_of(
+            "backup_messages", "backup_transcript", session_id=session_id
+        )
+        if messages is None:
+            continue
+        # Backups of the completed session duplicate the final transcript
+        if final_messages is None:
+            duplicate = False
+        elif final_session_id is not None:
+            duplicate = session_id == final_session_id
+        else:
+            duplicate = is_prefix(messages, final_messages)
+        if duplicate:
+            final_session_id = session_id
+            final_times = {message["position"]: message["time"] for message in messages}
+            continue
+        info = info_of("backup_time", session_id)
+        start_time = info.get("start_time")
+        if start_time is None:
+            start_time = datetime.datetime.strptime(
+                session_id, SESSION_ID_FORMAT
+            ).timestamp()
+        duration = info.get("duration_minutes")
+        sessions.append((session_id, "incomplete", start_time, duration, None, messages))
+
+    if final_messages is not None:
+        for message in final_messages:
+            if message["time"] is None:
+                message["time"] = final_times.get(message["position"])
+        info = info_of("final_time")
+        sessions.append(
+            (
+                final_session_id,
+                "completed",
+                info.get("start_time"),
+                info.get("duration_minutes"),
+                info_of("final_metadata").get("model"),
+                final_messages,
+            )
+        )
+
+    for session_id, status, start_time, duration, model, messages in sessions:
+        for message in messages:
+            yield {
+                "study": study,
+                "username": username,
+                "session_id": session_id,
+                "status": status,
+                "start_time": timestamp(start_time),
+                "duration_minutes": duration,
+                "model": model,
+                "position": message["position"],
+                "role": message["role"],
+                "content": message["content"],
+                "time": timestamp(message["time"]),
+            }
+
+
+def export(
+    output_directory,
+    study="interviews",
+    directories=None,
+    workers=None,
+    file_format="parquet",
+):
+    """Export (incrementally) the data directories into `<output>/<study>.<format>`.
+
+    Returns the numbers of parsed, unchanged and removed files and exported rows.
+    """
+
+    directories = directories or {
+        "transcripts": config.TRANSCRIPTS_DIRECTORY,
+        "times": config.TIMES_DIRECTORY,
+        "backups": config.BACKUPS_DIRECTORY,
+    }
+    parts_directory = os.path.join(output_directory, ".parts", study)
+    os.makedirs(parts_directory, exist_ok=True)
+    manifest_path = os.path.join(output_directory, f"{study}.manifest.json")
+
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+    # Only new or changed files (by mtime and size) are parsed again
+    current = {}
+    tasks = []
+    for relative_path, path, stat in scan(directories):
+        kind, username, session_id = classify(*relative_path.split("/", 1))
+        entry = {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "kind": kind,
+            "username": username,
+            "session_id": session_id,
+            "part": hashlib.sha1(relative_path.encode()).hexdigest() + ".arrow",
+        }
+        previous = manifest.get(relative_path)
+        if (
+            previous is not None
+            and previous["mtime"] == entry["mtime"]
+            and previous["size"] == entry["size"]
+        ):
+            current[relative_path] = previous
+        else:
+            current[relative_path] = entry
+            tasks.append((relative_path, path))
+
+    if tasks:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                (
+                    relative_path,
+                    executor.submit(
+                        parse_file,
+                        path,
+                        current[relative_path]["kind"],
+                        os.path.join(parts_directory, current[relative_path]["part"]),
+                    ),
+                )
+                for relative_path, path in tasks
+            ]
+            for relative_path, future in futures:
+                try:
+                    current[relative_path]["info"] = future.result()
+                except Exception:
+                    # Left out of the manifest, so the file is parsed again next time
+                    logger.exception(f"Could not parse {relative_path}")
+                    del current[relative_path]
+
+    removed = [path for path in manifest if path not in current]
+    for relative_path in removed:
+        part_path = os.path.join(parts_directory, manifest[relative_path]["part"])
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+    # Write the table user by user (in row groups) into a temporary file
+    files_by_user = {}
+    for entry in current.values():
+        files_by_user.setdefault(entry["username"], []).append(entry)
+
+    output_path = os.path.join(output_directory, f"{study}.{file_format}")
+    temporary_path = f"{output_path}.tmp"
+    if file_format == "parquet":
+        writer = pq.ParquetWriter(temporary_path, SCHEMA)
+    elif file_format == "arrow":
+        writer = pa.ipc.new_file(temporary_path, SCHEMA)
+    else:
+        raise ValueError("Format must be 'parquet' or 'arrow'.")
+
+    rows = []
+    n_rows = 0
+    with writer:
+        for username in sorted(files_by_user):
+            rows.extend(
+                user_rows(study, username, files_by_user[username], parts_directory)
+            )
+            if len(rows) >= ROW_GROUP_SIZE:
+                writer.write_table(pa.Table.from_pylist(rows, schema=SCHEMA))
+                n_rows += len(rows)
+                rows = []
+        if rows or not n_rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=SCHEMA))
+            n_rows += len(rows)
+    os.replace(temporary_path, output_path)
+
+    # Manifest last, so that an interrupted export parses the files again
+    write_atomic(manifest_path, json.dumps(current))
+
+    return {
+        "parsed": len(tasks),
+        "unchanged": len(current) - len(tasks),
+        "removed": len(removed),
+        "rows": n_rows,
+    }
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Export transcripts, times and backups into a columnar table."
+    )
+    parser.add_argument("output", help="Directory for the table and its manifest.")
+    parser.add_argument(
+        "--study",
+        default="interviews",
+        help="Name of the table (and of the study, if one has this name).",
+    )
+    parser.add_argument(
+        "--data",
+        help="Data directory with transcripts/, times/ and backups/ (default from config).",
+    )
+    parser.add_argument("--workers", type=int, help="Processes (default: CPU count).")
+    parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet")
+    args = parser.parse_args()
+
+    directories = None
+    if args.data:
+        directories = {
+            label: os.path.join(args.data, label)
+            for label in ("transcripts", "times", "backups")
+        }
+    elif args.study in get_study_registry().names():
+        # Data directories of a study served with `?study=<name>`
+        study = get_study_registry().get(args.study)
+        directories = {
+            "transcripts": study.TRANSCRIPTS_DIRECTORY,
+            "times": study.TIMES_DIRECTORY,
+            "backups": study.BACKUPS_DIRECTORY,
+        }
+
+    summary = export(
+        args.output,
+        study=args.study,
+        directories=directories,
+        workers=args.workers,
+        file_format=args.format,
+    )
+    print(
+        f"Parsed {summary['parsed']} files ({summary['unchanged']} unchanged, "
+        f"{summary['removed']} removed), exported {summary['rows']} rows to {args.output}"
+    )
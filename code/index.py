@@ -0,0 +1,198 @@
+import time
+from storage import SQLiteDatabase
+
+
+# Index of live and completed sessions for the admin dashboard (admin.py): one row per
+# session and one row per interviewer turn, updated whenever interview data is saved, so
+# that the dashboard queries a few indexed tables instead of scanning the data directories
+
+
+class SessionIndex(SQLiteDatabase):
+    """Sessions and turn metrics of all studies in one SQLite database in WAL mode."""
+
+    def __init__(self, path):
+        super().__init__(path)
+
+        self.connection().executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                study TEXT NOT NULL,
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                start_time REAL NOT NULL,
+                last_save REAL NOT NULL,
+                end_time REAL,
+                messages INTEGER NOT NULL,
+                section TEXT,
+                code TEXT,
+                model TEXT,
+                PRIMARY KEY (study, username, session_id)
+            );
+            CREATE INDEX IF NOT EXISTS sessions_study_status
+                ON sessions (study, status, last_save);
+            CREATE INDEX IF NOT EXISTS sessions_study_last_save
+                ON sessions (study, last_save);
+            CREATE TABLE IF NOT EXISTS turns (
+                study TEXT NOT NULL,
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                turn INTEGER NOT NULL,
+                time REAL NOT NULL,
+                section TEXT,
+                time_to_first_token REAL,
+                stream_seconds REAL,
+                rerun_seconds REAL,
+                output_tokens INTEGER,
+                PRIMARY KEY (study, username, session_id, turn)
+            );
+            CREATE INDEX IF NOT EXISTS turns_study_time ON turns (study, time);
+            CREATE INDEX IF NOT EXISTS turns_study_section ON turns (study, section);
+            """
+        )
+
+    def update(
+        self,
+        study,
+        username,
+        session_id,
+        start_time,
+        messages,
+        section,
+        model,
+        turn_metrics=(),
+        end_time=None,
+        code=None,
+    ):
+        """Upsert the row of a session (completed if `end_time` is given) and insert the
+        metrics of its new turns, in one transaction."""
+
+        now = time.time()
+        with self.connection() as connection:
+            connection.execute(
+                """INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (study, username, session_id) DO UPDATE SET
+                    status = excluded.status,
+                    last_save = excluded.last_save,
+                    end_time = excluded.end_time,
+                    messages = excluded.messages,
+                    section = excluded.section,
+                    code = excluded.code""",
+                (
+                    study,
+                    username,
+                    session_id,
+                    "completed" if end_time is not None else "active",
+                    start_time,
+                    now,
+                    end_time,
+                    messages,
+                    section,
+                    code,
+                    model,
+                ),
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO turns VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        study,
+                        username,
+                        session_id,
+                        metrics["turn"],
+                        now,
+                        metrics["section"],
+                        metrics["time_to_first_token"],
+                        metrics["stream_seconds"],
+                        metrics["rerun_seconds"],
+                        metrics["output_tokens"],
+                    )
+                    for metrics in turn_metrics
+                ],
+            )
+
+    def studies(self):
+        # Skip scan over the primary key, one lookup per study
+        studies = []
+        row = self.connection().execute("SELECT MIN(study) FROM sessions").fetchone()
+        while row[0] is not None:
+            studies.append(row[0])
+            row = (
+                self.connection()
+                .execute("SELECT MIN(study) FROM sessions WHERE study > ?", (row[0],))
+                .fetchone()
+            )
+        return studies
+
+    def status_counts(self, study, abandoned_after):
+        """Numbers of active, abandoned (no save for `abandoned_after` seconds) and
+        completed sessions."""
+
+        cutoff = time.time() - abandoned_after
+        connection = self.connection()
+        counts = {}
+        for status, condition in (
+            ("active", "status = 'active' AND last_save >= ?"),
+            ("abandoned", "status = 'active' AND last_save < ?"),
+            ("completed", "status = 'completed'"),
+        ):
+            parameters = (study, cutoff) if "?" in condition else (study,)
+            counts[status] = connection.execute(
+                f"SELECT COUNT(*) FROM sessions WHERE study = ? AND {condition}",
+                parameters,
+            ).fetchone()[0]
+        return counts
+
+    def code_counts(self, study):
+        """Numbers of completed sessions by closing code (None if the respondent quit)."""
+
+        return dict(
+            self.connection().execute(
+                """SELECT code, COUNT(*) FROM sessions
+                WHERE study = ? AND status = 'completed' GROUP BY code""",
+                (study,),
+            )
+        )
+
+    def section_turns(self, study):
+        """Number of interviewer turns by section of the interview."""
+
+        return dict(
+            self.connection().execute(
+                "SELECT section, COUNT(*) FROM turns WHERE study = ? GROUP BY section",
+                (study,),
+            )
+        )
+
+    def duration_histogram(self, study, bin_minutes=5):
+        """Numbers of completed sessions by duration (start of bins in minutes)."""
+
+        return dict(
+            self.connection().execute(
+                """SELECT CAST((end_time - start_time) / (60 * ?) AS INTEGER) * ?,
+                    COUNT(*)
+                FROM sessions WHERE study = ? AND status = 'completed'
+                GROUP BY 1 ORDER BY 1""",
+                (bin_minutes, bin_minutes, study),
+            )
+        )
+
+    def recent_turns(self, study, since, limit=50000):
+        """Turn metrics of a study since a time (newest first, at most `limit`)."""
+
+        return self.connection().execute(
+            """SELECT turn, section, time_to_first_token, stream_seconds, rerun_seconds,
+                output_tokens, time
+            FROM turns WHERE study = ? AND time >= ? ORDER BY time DESC LIMIT ?""",
+            (study, since, limit),
+        ).fetchall()
+
+    def recent_sessions(self, study, limit=100):
+        """Most recently saved sessions of a study."""
+
+        return self.connection().execute(
+            """SELECT username, session_id, status, start_time, last_save, end_time,
+                messages, section, code, model
+            FROM sessions WHERE study = ? ORDER BY last_save DESC LIMIT ?""",
+            (study, limit),
+        ).fetchall()
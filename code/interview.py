@@ -3,27 +3,61 @@ import time
 from utils import (
     check_password,
     check_if_interview_completed,
+    owns_session,
     save_interview_data,
+    start_session,
 )
-import os
+from resources import (
+    api_of_model,
+    get_async_client,
+    get_api_kwargs,
+    setup_directories,
+)
+from streaming import stream_reply, ThrottledMarkdown
+from context import ContextManager, summary_api_kwargs
+from codes import CodeDetector, get_code_automaton
+from metrics import TurnTimer, record_turn, section_of
+from session import get_session_registry
+from opening import get_opening_cache, opening_request
+from studies import get_study_registry
 import config
 
-# Load API library
-if "gpt" in config.MODEL.lower():
-    api = "openai"
-    from openai import OpenAI
-
-elif "claude" in config.MODEL.lower():
-    api = "anthropic"
-    import anthropic
-else:
-    raise ValueError(
-        "Model does not contain 'gpt' or 'claude'; unable to determine API."
-    )
+# Start of this script run (for per-turn metrics)
+rerun_start = time.perf_counter()
 
 # Set page title and icon
 st.set_page_config(page_title="Interview", page_icon=config.AVATAR_INTERVIEWER)
 
+# Determine the study from the URL parameter `?study=<name>` (config.py if not given);
+# studies are validated and cached per process, and a session keeps the version of the
+# study it started with
+if "study" not in st.session_state:
+    try:
+        st.session_state.study = get_study_registry().get(st.query_params.get("study"))
+    except KeyError:
+        st.error("This study does not exist.")
+        st.stop()
+    except ValueError:
+        # Invalid study file (logged by the registry once per version of the file)
+        st.error("This study is currently unavailable, please try again later.")
+        st.stop()
+study = st.session_state.study
+
+# Determine API
+api = api_of_model(study.MODEL)
+
+# Load API client (created once per process and shared by all sessions)
+if api == "openai":
+    async_client = get_async_client(st.secrets["API_KEY_OPENAI"], api)
+elif api == "anthropic":
+    async_client = get_async_client(st.secrets["API_KEY_ANTHROPIC"], api)
+
+# Generate the opening message of the study in the background (once per version of the
+# study) while the respondent is still logging in, so that new sessions do not wait
+# for the API
+if config.PREFETCH_OPENING_MESSAGE:
+    get_opening_cache().warm(study, async_client, api)
+
 # Check if usernames and logins are enabled
 if config.LOGINS:
     # Check password (displays login screen)
@@ -35,41 +69,56 @@ if config.LOGINS:
 else:
     st.session_state.username = "testaccount"
 
-# Create directories if they do not already exist
-if not os.path.exists(config.TRANSCRIPTS_DIRECTORY):
-    os.makedirs(config.TRANSCRIPTS_DIRECTORY)
-if not os.path.exists(config.TIMES_DIRECTORY):
-    os.makedirs(config.TIMES_DIRECTORY)
-if not os.path.exists(config.BACKUPS_DIRECTORY):
-    os.makedirs(config.BACKUPS_DIRECTORY)
+# Create directories of the study if they do not already exist (only once per process)
+setup_directories(study)
 
 
 # Initialise session state
 if "interview_active" not in st.session_state:
     st.session_state.interview_active = True
 
-# Initialise messages list in session state
+# Initialise context manager which fits the history sent to the API into the budget
+if "context" not in st.session_state:
+    st.session_state.context = ContextManager(
+        api, study.CONTEXT_TOKEN_BUDGET, study=study
+    )
+
+# Initialise per-turn metrics and the current section of the interview
+if "turn_metrics" not in st.session_state:
+    st.session_state.turn_metrics = []
+    st.session_state.section = "Part I"
+
+# Store start time and messages in session state, resumed from storage if the user has
+# an unfinished session (e.g. after a restart or on another worker); older messages are
+# read back from storage when needed, so only the recent ones are kept in memory
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    start_session(st.session_state.username)
 
-# Store start time in session state
-if "start_time" not in st.session_state:
-    st.session_state.start_time = time.time()
-    st.session_state.start_time_file_names = time.strftime(
-        "%Y_%m_%d_%H_%M_%S", time.localtime(st.session_state.start_time)
-    )
+# Record activity of the session (sessions idle for long release their messages), and
+# read the messages the API still needs back into memory once if they were released
+get_session_registry().touch(st.session_state.messages)
+st.session_state.messages.restore(st.session_state.context.first_needed())
+
+# Stop if the interview was continued in a newer session (in another window or on
+# another worker)
+if not owns_session(st.session_state.username):
+    st.session_state.interview_active = False
+    st.markdown("This interview was continued in another window.")
+    st.stop()
 
 # Check if interview previously completed
 interview_previously_completed = check_if_interview_completed(
-    config.TIMES_DIRECTORY, st.session_state.username
+    st.session_state.username
 )
 
-# If app started but interview was previously completed
+# If app started but interview was previously completed (no new session is started, so
+# nothing is generated, stored or added to the session index)
 if interview_previously_completed and not st.session_state.messages:
 
     st.session_state.interview_active = False
     completed_message = "Interview already completed."
     st.markdown(completed_message)
+    st.stop()
 
 # Add 'Quit' button to dashboard
 col1, col2 = st.columns([0.85, 0.15])
@@ -85,78 +134,131 @@ with col2:
         st.session_state.interview_active = False
         quit_message = "You have cancelled the interview."
         st.session_state.messages.append({"role": "assistant", "content": quit_message})
-        save_interview_data(
-            st.session_state.username,
-            config.TRANSCRIPTS_DIRECTORY,
-            config.TIMES_DIRECTORY,
-        )
+        save_interview_data(st.session_state.username, final=True)
 
 
-# Upon rerun, display the previous conversation (except system prompt or first message)
-for message in st.session_state.messages[1:]:
+# Upon rerun, display the previous conversation (except system prompt or first message);
+# messages released from memory are only read back if the respondent wants to see them
+history_start = max(st.session_state.messages.spilled, 1)
+if history_start > 1 and st.toggle("Show earlier messages"):
+    history_start = 1
+for message in st.session_state.messages[history_start:]:
 
     if message["role"] == "assistant":
         avatar = config.AVATAR_INTERVIEWER
     else:
         avatar = config.AVATAR_RESPONDENT
-    # Only display messages without codes
-    if not any(code in message["content"] for code in config.CLOSING_MESSAGES.keys()):
+    # Only display messages without codes (flagged when the message was streamed)
+    if not message.get("code"):
         with st.chat_message(message["role"], avatar=avatar):
             st.markdown(message["content"])
 
-# Load API client
-if api == "openai":
-    client = OpenAI(api_key=st.secrets["API_KEY_OPENAI"])
-    api_kwargs = {"stream": True}
-elif api == "anthropic":
-    client = anthropic.Anthropic(api_key=st.secrets["API_KEY_ANTHROPIC"])
-    api_kwargs = {"system": config.SYSTEM_PROMPT}
-
 # API kwargs
-api_kwargs["messages"] = st.session_state.messages
-api_kwargs["model"] = config.MODEL
-api_kwargs["max_tokens"] = config.MAX_OUTPUT_TOKENS
-if config.TEMPERATURE is not None:
-    api_kwargs["temperature"] = config.TEMPERATURE
+api_kwargs = get_api_kwargs(st.session_state.messages, study)
+
+
+def prepare_api_kwargs():
+    """API kwargs with the history fitted into the token budget."""
+
+    return st.session_state.context.prepare(api_kwargs, summarize=summarize)
+
+
+def summarize(messages, previous_summary):
+    """Summarise earlier messages of the interview (through the same scheduler)."""
+
+    return "".join(
+        stream_reply(
+            async_client,
+            api,
+            summary_api_kwargs(messages, previous_summary, study),
+            record_usage=lambda usage: None,
+        )
+    )
+
+
+def stream_interviewer_message(timer):
+    """Yield batches of text of the next interviewer message and record token usage."""
+
+    context = st.session_state.context
+    if api == "openai":
+        record_usage = context.record_openai_usage
+    elif api == "anthropic":
+        record_usage = context.record_anthropic_usage
+
+    timer.mark("api_call")
+    try:
+        for text in stream_reply(async_client, api, prepare_api_kwargs(), record_usage):
+            timer.mark_once("first_delta")
+            yield text
+    finally:
+        timer.mark("stream_end")
+
+
+def record_turn_metrics(timer, usage_count, message):
+    """Store (and export) the metrics of the interviewer turn which produced `message`."""
+
+    usage = st.session_state.context.usage
+    st.session_state.section = section_of(
+        message, st.session_state.section, study.SECTIONS
+    )
+    st.session_state.turn_metrics.append(
+        record_turn(
+            timer,
+            usage[-1] if len(usage) > usage_count else None,
+            study.MODEL,
+            st.session_state.section,
+            len(st.session_state.turn_metrics) + 1,
+            st.session_state.messages.memory(),
+        )
+    )
+
 
 # In case the interview history is still empty, pass system prompt to model, and
 # generate and display its first message
 if not st.session_state.messages:
 
     if api == "openai":
-
         st.session_state.messages.append(
-            {"role": "system", "content": config.SYSTEM_PROMPT}
+            {"role": "system", "content": study.SYSTEM_PROMPT}
         )
-        with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
-            stream = client.chat.completions.create(**api_kwargs)
-            message_interviewer = st.write_stream(stream)
-
     elif api == "anthropic":
-
         st.session_state.messages.append({"role": "user", "content": "Hi"})
-        with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
-            message_placeholder = st.empty()
+
+    timer = TurnTimer(rerun_start)
+    usage_count = len(st.session_state.context.usage)
+
+    # Opening message prefetched for this version of the study (if already generated)
+    opening = None
+    if config.PREFETCH_OPENING_MESSAGE:
+        opening_key = opening_request(study, api)[0]
+        opening = get_opening_cache().get(opening_key)
+
+    with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
+        if opening is not None:
+            message_interviewer = opening
+            st.markdown(message_interviewer)
+        else:
+            message_display = ThrottledMarkdown(st.empty())
             message_interviewer = ""
-            with client.messages.stream(**api_kwargs) as stream:
-                for text_delta in stream.text_stream:
-                    if text_delta != None:
-                        message_interviewer += text_delta
-                    message_placeholder.markdown(message_interviewer + "▌")
-            message_placeholder.markdown(message_interviewer)
+            for text_delta in stream_interviewer_message(timer):
+                message_interviewer += text_delta
+                message_display.update(message_interviewer)
+            message_display.finish(message_interviewer)
+        timer.mark("rendered")
+
+    # An opening streamed before the prefetch finished serves later sessions
+    if config.PREFETCH_OPENING_MESSAGE and opening is None:
+        get_opening_cache().put(opening_key, message_interviewer, study)
 
     st.session_state.messages.append(
         {"role": "assistant", "content": message_interviewer}
     )
 
     # Store first backup files to record who started the interview
-    save_interview_data(
-        username=st.session_state.username,
-        transcripts_directory=config.BACKUPS_DIRECTORY,
-        times_directory=config.BACKUPS_DIRECTORY,
-        file_name_addition_transcript=f"_transcript_started_{st.session_state.start_time_file_names}",
-        file_name_addition_time=f"_time_started_{st.session_state.start_time_file_names}",
-    )
+    timer.mark("save_start")
+    save_interview_data(st.session_state.username)
+    timer.mark("saved")
+    record_turn_metrics(timer, usage_count, message_interviewer)
 
 
 # Main chat if interview is active
@@ -175,105 +277,73 @@ if st.session_state.interview_active:
         # Generate and display interviewer message
         with st.chat_message("assistant", avatar=config.AVATAR_INTERVIEWER):
 
-            # Create placeholder for message in chat interface
-            message_placeholder = st.empty()
+            # Create placeholder for message in chat interface (with throttled repaints)
+            message_display = ThrottledMarkdown(st.empty())
 
-            # Initialise message of interviewer
+            # Initialise message of interviewer and the part of it safe to display
             message_interviewer = ""
-
-            if api == "openai":
-
-                # Stream responses
-                stream = client.chat.completions.create(**api_kwargs)
-
-                for message in stream:
-                    text_delta = message.choices[0].delta.content
-                    if text_delta != None:
-                        message_interviewer += text_delta
-                    # Start displaying message only after 5 characters to first check for codes
-                    if len(message_interviewer) > 5:
-                        message_placeholder.markdown(message_interviewer + "▌")
-                    if any(
-                        code in message_interviewer
-                        for code in config.CLOSING_MESSAGES.keys()
-                    ):
-                        # Stop displaying the progress of the message in case of a code
-                        message_placeholder.empty()
-                        break
-
-            elif api == "anthropic":
-
-                # Stream responses
-                with client.messages.stream(**api_kwargs) as stream:
-                    for text_delta in stream.text_stream:
-                        if text_delta != None:
-                            message_interviewer += text_delta
-                        # Start displaying message only after 5 characters to first check for codes
-                        if len(message_interviewer) > 5:
-                            message_placeholder.markdown(message_interviewer + "▌")
-                        if any(
-                            code in message_interviewer
-                            for code in config.CLOSING_MESSAGES.keys()
-                        ):
-                            # Stop displaying the progress of the message in case of a code
-                            message_placeholder.empty()
-                            break
+            message_displayed = ""
+
+            # Detector for closing codes which holds back text that could become a code
+            code_detector = CodeDetector(
+                get_code_automaton(tuple(study.CLOSING_MESSAGES.keys()))
+            )
+
+            # Timestamps of this turn (API call, first text, stream end, render, save)
+            timer = TurnTimer(rerun_start)
+            usage_count = len(st.session_state.context.usage)
+
+            # Stream responses
+            for text_delta in stream_interviewer_message(timer):
+                message_interviewer += text_delta
+                message_displayed += code_detector.feed(text_delta)
+                if code_detector.code is not None:
+                    # Stop displaying the progress of the message in case of a code
+                    message_display.clear()
+                    break
+                message_display.update(message_displayed)
 
             # If no code is in the message, display and store the message
-            if not any(
-                code in message_interviewer for code in config.CLOSING_MESSAGES.keys()
-            ):
+            if code_detector.code is None:
 
-                message_placeholder.markdown(message_interviewer)
+                message_display.finish(message_interviewer)
+                timer.mark("rendered")
                 st.session_state.messages.append(
                     {"role": "assistant", "content": message_interviewer}
                 )
 
-                # Regularly store interview progress as backup, but prevent script from
-                # stopping in case of a write error
-                try:
+                # Regularly store interview progress as backup (write errors do not stop
+                # the script, unsaved messages are included in the next backup)
+                timer.mark("save_start")
+                save_interview_data(st.session_state.username)
+                timer.mark("saved")
+                record_turn_metrics(timer, usage_count, message_interviewer)
 
-                    save_interview_data(
-                        username=st.session_state.username,
-                        transcripts_directory=config.BACKUPS_DIRECTORY,
-                        times_directory=config.BACKUPS_DIRECTORY,
-                        file_name_addition_transcript=f"_transcript_started_{st.session_state.start_time_file_names}",
-                        file_name_addition_time=f"_time_started_{st.session_state.start_time_file_names}",
-                    )
+            # If code in the message, display the associated closing message instead
+            else:
 
-                except:
+                # Store message in list of messages, flagged with its code
+                st.session_state.messages.append(
+                    {
+                        "role": "assistant",
+                        "content": message_interviewer,
+                        "code": code_detector.code,
+                    }
+                )
 
-                    pass
+                # Set chat to inactive and display closing message
+                st.session_state.interview_active = False
+                closing_message = study.CLOSING_MESSAGES[code_detector.code]
+                st.markdown(closing_message)
+                timer.mark("rendered")
+                st.session_state.messages.append(
+                    {"role": "assistant", "content": closing_message}
+                )
 
-            # If code in the message, display the associated closing message instead
-            # Loop over all codes
-            for code in config.CLOSING_MESSAGES.keys():
-
-                if code in message_interviewer:
-                    # Store message in list of messages
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": message_interviewer}
-                    )
-
-                    # Set chat to inactive and display closing message
-                    st.session_state.interview_active = False
-                    closing_message = config.CLOSING_MESSAGES[code]
-                    st.markdown(closing_message)
-                    st.session_state.messages.append(
-                        {"role": "assistant", "content": closing_message}
-                    )
-
-                    # Store final transcript and time
-                    final_transcript_stored = False
-                    while final_transcript_stored == False:
-
-                        save_interview_data(
-                            username=st.session_state.username,
-                            transcripts_directory=config.TRANSCRIPTS_DIRECTORY,
-                            times_directory=config.TIMES_DIRECTORY,
-                        )
-
-                        final_transcript_stored = check_if_interview_completed(
-                            config.TRANSCRIPTS_DIRECTORY, st.session_state.username
-                        )
-                        time.sleep(0.1)
+                # Metrics of the last turn are recorded before the final save so that
+                # they are part of the stored metadata (without save time)
+                record_turn_metrics(timer, usage_count, message_interviewer)
+
+                # Store final transcript and time (retried in the background if the
+                # disk keeps failing)
+                save_interview_data(st.session_state.username, final=True)
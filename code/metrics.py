@@ -0,0 +1,211 @@
+import time
+import config
+from resources import connection_stats, get_scheduler, once_per_process
+
+
+# Per-turn instrumentation: timestamps of each interviewer turn are turned into latency and
+# token metrics, which are stored with the transcript metadata and optionally exported to
+# a local Prometheus endpoint and/or an OTLP JSON file
+
+
+class TurnTimer:
+    """Collects the timestamps of one interviewer turn.
+
+    Events: "api_call", "first_delta", "stream_end", "rendered", "save_start", "saved";
+    `rerun_start` is the start of the script run which produced the turn.
+    """
+
+    def __init__(self, rerun_start):
+        self.rerun_start = rerun_start
+        self.times = {}
+
+    def mark(self, event):
+        self.times[event] = time.perf_counter()
+
+    def mark_once(self, event):
+        if event not in self.times:
+            self.mark(event)
+
+    def duration(self, start, end):
+        if start in self.times and end in self.times:
+            return self.times[end] - self.times[start]
+        return None
+
+
+def section_of(message, section, sections=None):
+    """Section of the interview after an interviewer message (from config.SECTIONS by
+    default)."""
+
+    sections = config.SECTIONS if sections is None else sections
+    for name, marker in sections.items():
+        if marker and marker in message:
+            return name
+    return section
+
+
+def record_turn(timer, usage, model, section, turn, memory=None):
+    """Compute the metrics of one turn, export them and return them as dictionary."""
+
+    stream_seconds = timer.duration("first_delta", "stream_end")
+    output_tokens = usage["output_tokens"] if usage else None
+    metrics = {
+        "turn": turn,
+        "model": model,
+        "section": section,
+        "time_to_first_token": timer.duration("api_call", "first_delta"),
+        "stream_seconds": stream_seconds,
+        "tokens_per_second": (
+            output_tokens / stream_seconds
+            if output_tokens and stream_seconds
+            else None
+        ),
+        "input_tokens": usage["input_tokens"] if usage else None,
+        "cached_input_tokens": usage["cached_input_tokens"] if usage else None,
+        "output_tokens": output_tokens,
+        "render_seconds": timer.duration("stream_end", "rendered"),
+        "save_seconds": timer.duration("save_start", "saved"),
+        "rerun_seconds": time.perf_counter() - timer.rerun_start,
+        "session_memory_bytes": memory,
+    }
+
+    for exporter in get_exporters():
+        exporter.export(metrics)
+
+    return metrics
+
+
+# Metrics exported as histograms (seconds or tokens per second) and counters (tokens)
+HISTOGRAMS = {
+    "time_to_first_token": "Time from API call to first streamed text (seconds)",
+    "stream_seconds": "Time from first to last streamed text (seconds)",
+    "tokens_per_second": "Output tokens per second while streaming",
+    "render_seconds": "Time to render the finished message (seconds)",
+    "save_seconds": "Time to store the backup of the turn (seconds)",
+    "rerun_seconds": "Duration of the Streamlit script run of the turn (seconds)",
+    "session_memory_bytes": "Memory of the messages a session holds (bytes)",
+}
+COUNTERS = {
+    "input_tokens": "Input tokens sent to the API",
+    "cached_input_tokens": "Input tokens read from the prompt cache",
+    "output_tokens": "Output tokens received from the API",
+}
+
+# Metrics of the process (shared scheduler and HTTP connection pool) exported as gauges
+GAUGES = {
+    "scheduler_queued": "API requests waiting for rate limits or a free slot",
+    "scheduler_in_flight": "API requests being streamed",
+    "scheduler_requests": "API requests scheduled since start",
+    "scheduler_retries": "Retries of API requests since start",
+    "scheduler_fallbacks": "API requests sent to the fallback model since start",
+    "scheduler_failures": "API requests failed since start",
+    "scheduler_wait_time_mean": "Mean wait of recent requests before sending (seconds)",
+    "scheduler_wait_time_p95": "95th percentile wait of recent requests (seconds)",
+    "scheduler_wait_time_max": "Longest wait of recent requests (seconds)",
+    "connections_requests": "HTTP requests of the shared API client since start",
+    "connections_new_connections": "HTTP connections opened since start",
+    "connections_reused_connections": "Requests on a reused HTTP connection since start",
+    "connections_reuse_rate": "Share of HTTP requests on a reused connection",
+}
+
+
+def process_metrics():
+    """Current metrics of the scheduler and the HTTP connection pool of the process."""
+
+    metrics = {
+        f"scheduler_{name}": value for name, value in get_scheduler().metrics().items()
+    }
+    for name, value in connection_stats.summary().items():
+        metrics[f"connections_{name}"] = value
+    return metrics
+
+
+class PrometheusExporter:
+    """Serves per-turn metrics on a local Prometheus endpoint (requires prometheus_client)."""
+
+    def __init__(self, port):
+        from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+        labels = ["model", "section"]
+        self.histograms = {
+            name: Histogram(f"interview_{name}", description, labels)
+            for name, description in HISTOGRAMS.items()
+        }
+        self.counters = {
+            name: Counter(f"interview_{name}", description, labels)
+            for name, description in COUNTERS.items()
+        }
+        # Gauges read the current process metrics on every scrape
+        for name, description in GAUGES.items():
+            Gauge(f"interview_{name}", description).set_function(
+                lambda name=name: process_metrics()[name]
+            )
+        start_http_server(port)
+
+    def export(self, metrics):
+        labels = {"model": metrics["model"], "section": metrics["section"]}
+        for name, histogram in self.histograms.items():
+            if metrics[name] is not None:
+                histogram.labels(**labels).observe(metrics[name])
+        for name, counter in self.counters.items():
+            if metrics[name]:
+                counter.labels(**labels).inc(metrics[name])
+
+
+class OTLPFileExporter:
+    """Writes per-turn metrics as OTLP JSON lines to a file (requires opentelemetry-sdk)."""
+
+    def __init__(self, path, interval=10.0):
+        from opentelemetry.metrics import Observation
+        from opentelemetry.sdk.metrics import MeterProvider
+        from opentelemetry.sdk.metrics.export import (
+            ConsoleMetricExporter,
+            PeriodicExportingMetricReader,
+        )
+
+        self.file = open(path, "a")
+        reader = PeriodicExportingMetricReader(
+            ConsoleMetricExporter(
+                out=self.file,
+                formatter=lambda data: data.to_json(indent=None) + "\n",
+            ),
+            export_interval_millis=interval * 1000,
+        )
+        meter = MeterProvider(metric_readers=[reader]).get_meter("interviews")
+        self.histograms = {
+            name: meter.create_histogram(f"interview.{name}", description=description)
+            for name, description in HISTOGRAMS.items()
+        }
+        self.counters = {
+            name: meter.create_counter(f"interview.{name}", description=description)
+            for name, description in COUNTERS.items()
+        }
+        for name, description in GAUGES.items():
+            meter.create_observable_gauge(
+                f"interview.{name}",
+                callbacks=[
+                    lambda options, name=name: [Observation(process_metrics()[name])]
+                ],
+                description=description,
+            )
+
+    def export(self, metrics):
+        attributes = {"model": metrics["model"], "section": metrics["section"]}
+        for name, histogram in self.histograms.items():
+            if metrics[name] is not None:
+                histogram.record(metrics[name], attributes)
+        for name, counter in self.counters.items():
+            if metrics[name]:
+                counter.add(metrics[name], attributes)
+
+
+@once_per_process
+def get_exporters():
+    """Create the exporters enabled in config.py once per process (a second Prometheus
+    registry or HTTP server on the same port would fail)."""
+
+    exporters = []
+    if config.PROMETHEUS_PORT is not None:
+        exporters.append(PrometheusExporter(config.PROMETHEUS_PORT))
+    if config.OTLP_METRICS_FILE is not None:
+        exporters.append(OTLPFileExporter(config.OTLP_METRICS_FILE))
+    return exporters
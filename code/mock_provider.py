@@ -0,0 +1,328 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Local mock of the OpenAI and Anthropic APIs (streaming and non-streaming) for
+# benchmarks and offline runs; point the SDKs at it with OPENAI_BASE_URL or
+# ANTHROPIC_BASE_URL
+
+
+class MockProvider:
+    """Settings and counters of the mock provider.
+
+    Replies consist of `reply_tokens` words. The first token is sent after
+    `first_token_latency` seconds, further tokens at `tokens_per_second`. If the last
+    respondent message contains `end_phrase`, the reply is `end_code`.
+
+    To exercise retries and the fallback model, a share `error_rate` of requests (and
+    all requests for `failing_models`) is answered with the HTTP status `error_status`
+    and, if `retry_after` is set, a retry-after header.
+    """
+
+    def __init__(
+        self,
+        first_token_latency=0.3,
+        tokens_per_second=50.0,
+        reply_tokens=40,
+        end_phrase="That is all from my side.",
+        end_code="x7y8",
+        replies=None,
+        error_rate=0.0,
+        error_status=429,
+        retry_after=None,
+        failing_models=(),
+    ):
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.reply_tokens = reply_tokens
+        self.end_phrase = end_phrase
+        self.end_code = end_code
+        # Optional function from (messages, system) to reply text
+        self.replies = replies
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.failing_models = set(failing_models)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def fails(self, model):
+        """Whether to answer a request for the model with an error (counted)."""
+
+        if model in self.failing_models or random.random() < self.error_rate:
+            with self.lock:
+                self.errors += 1
+            return True
+        return False
+
+    def reply(self, messages, system):
+        if self.replies is not None:
+            return self.replies(messages, system)
+        last = content_text(messages[-1]["content"]) if messages else ""
+        if self.end_phrase in last:
+            return self.end_code
+        words = ["Could", "you", "tell", "me", "more", "about", "that"]
+        return " ".join(words[i % len(words)] for i in range(self.reply_tokens)) + "?"
+
+    def tokens(self, text):
+        """Split a reply into tokens (words with their following space)."""
+
+        words = text.split(" ")
+        return [word + " " for word in words[:-1]] + [words[-1]]
+
+
+def content_text(content):
+    if isinstance(content, str):
+        return content
+    return "".join(block.get("text", "") for block in content)
+
+
+def make_handler(provider):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            with provider.lock:
+                provider.requests += 1
+
+            messages = body.get("messages", [])
+            if self.path.endswith("/chat/completions"):
+                system = next(
+                    (m["content"] for m in messages if m["role"] == "system"), ""
+                )
+                messages = [m for m in messages if m["role"] != "system"]
+                api = "openai"
+            elif self.path.endswith("/messages"):
+                system = content_text(body.get("system", ""))
+                api = "anthropic"
+            else:
+                self.send_error(404)
+                return
+
+            if provider.fails(body.get("model")):
+                self.send_api_error(api)
+                return
+
+            text = provider.reply(messages, system)
+            input_tokens = sum(
+                len(content_text(m["content"])) // 4 for m in messages
+            ) + len(system) // 4
+            output_tokens = len(provider.tokens(text))
+
+            time.sleep(provider.first_token_latency)
+            if not body.get("stream"):
+                time.sleep(output_tokens / provider.tokens_per_second)
+                self.send_json(
+                    openai_completion(body, text, input_tokens, output_tokens)
+                    if api == "openai"
+                    else anthropic_message(body, text, input_tokens, output_tokens)
+                )
+            elif api == "openai":
+                self.stream_openai(body, text, input_tokens, output_tokens)
+            else:
+                self.stream_anthropic(body, text, input_tokens, output_tokens)
+
+        def send_json(self, data):
+            payload = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def send_api_error(self, api):
+            """Error response in the format of the API (as the SDKs parse it)."""
+
+            message = f"Mock error {provider.error_status}"
+            if api == "openai":
+                error = {"error": {"message": message, "type": "mock_error"}}
+            else:
+                error = {"type": "error", "error": {"type": "mock_error"}}
+            error["error"]["message"] = message
+            payload = json.dumps(error).encode()
+            self.send_response(provider.error_status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            if provider.retry_after is not None:
+                self.send_header("retry-after", str(provider.retry_after))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def start_events(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+        def send_event(self, data, event=None):
+            payload = (f"event: {event}\n" if event else "") + f"data: {data}\n\n"
+            payload = payload.encode()
+            self.wfile.write(f"{len(payload):x}\r\n".encode() + payload + b"\r\n")
+            self.wfile.flush()
+
+        def end_events(self):
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def stream_openai(self, body, text, input_tokens, output_tokens):
+            self.start_events()
+            chunk = {
+                "id": "mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body["model"],
+            }
+            for i, token in enumerate(provider.tokens(text)):
+                if i:
+                    time.sleep(1 / provider.tokens_per_second)
+                delta = {"index": 0, "delta": {"content": token}, "finish_reason": None}
+                self.send_event(json.dumps({**chunk, "choices": [delta]}))
+            usage = {
+                "prompt_tokens": input_tokens,
+                "completion_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens,
+            }
+            if body.get("stream_options", {}).get("include_usage"):
+                self.send_event(json.dumps({**chunk, "choices": [], "usage": usage}))
+            self.send_event("[DONE]")
+            self.end_events()
+
+        def stream_anthropic(self, body, text, input_tokens, output_tokens):
+            self.start_events()
+            message = anthropic_message(body, "", input_tokens, 1)
+            message["content"] = []
+            events = [
+                ("message_start", {"type": "message_start", "message": message}),
+                (
+                    "content_block_start",
+                    {
+                        "type": "content_block_start",
+                        "index": 0,
+                        "content_block": {"type": "text", "text": ""},
+                    },
+                ),
+            ]
+            for name, event in events:
+                self.send_event(json.dumps(event), name)
+            for i, token in enumerate(provider.tokens(text)):
+                if i:
+                    time.sleep(1 / provider.tokens_per_second)
+                delta = {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": token},
+                }
+                self.send_event(json.dumps(delta), "content_block_delta")
+            events = [
+                ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                (
+                    "message_delta",
+                    {
+                        "type": "message_delta",
+                        "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                        "usage": {"output_tokens": output_tokens},
+                    },
+                ),
+                ("message_stop", {"type": "message_stop"}),
+            ]
+            for name, event in events:
+                self.send_event(json.dumps(event), name)
+            self.end_events()
+
+    return Handler
+
+
+def openai_completion(body, text, input_tokens, output_tokens):
+    return {
+        "id": "mock",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": input_tokens,
+            "completion_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        },
+    }
+
+
+def anthropic_message(body, text, input_tokens, output_tokens):
+    return {
+        "id": "mock",
+        "type": "message",
+        "role": "assistant",
+        "model": body["model"],
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 0,
+        },
+    }
+
+
+def start_mock_provider(provider=None, host="127.0.0.1", port=0):
+    """Start the mock provider in a background thread; returns the server and its URL."""
+
+    provider = provider or MockProvider()
+    server = ThreadingHTTPServer((host, port), make_handler(provider))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+if __name__ == "__main__":
+
+    # Standalone mock provider, e.g. for `streamlit run interview.py` without API costs:
+    # OPENAI_BASE_URL=http://127.0.0.1:8765/v1 or ANTHROPIC_BASE_URL=http://127.0.0.1:8765
+    parser = argparse.ArgumentParser(description="Mock OpenAI/Anthropic API server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument(
+        "--error-rate", type=float, default=0.0, help="Share of requests which fail."
+    )
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--retry-after", type=float, help="retry-after header of errors.")
+    parser.add_argument(
+        "--failing-model",
+        action="append",
+        default=[],
+        help="Model whose requests always fail (to test the fallback model).",
+    )
+    args = parser.parse_args()
+
+    server, url = start_mock_provider(
+        MockProvider(
+            args.first_token_latency,
+            args.tokens_per_second,
+            args.reply_tokens,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+            retry_after=args.retry_after,
+            failing_models=args.failing_model,
+        ),
+        port=args.port,
+    )
+    print(f"Mock provider listening on {url}")
+    threading.Event().wait()
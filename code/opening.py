@@ -0,0 +1,116 @@
+import json
+import time
+import hashlib
+import logging
+import threading
+from resources import get_api_kwargs, once_per_process, once_per_study
+from streaming import stream_reply
+from context import ContextManager
+from codes import get_code_automaton
+
+
+logger = logging.getLogger(__name__)
+
+
+# The opening interviewer message only depends on the study (system prompt, model and
+# sampling settings), so it is generated once in the background per study version and
+# new sessions show it immediately instead of waiting for the API
+
+
+def initial_messages(study, api):
+    """Messages of a new session before the opening interviewer message."""
+
+    if api == "openai":
+        return [{"role": "system", "content": study.SYSTEM_PROMPT}]
+    elif api == "anthropic":
+        return [{"role": "user", "content": "Hi"}]
+
+
+@once_per_study
+def opening_request(study, api):
+    """Key and API kwargs of the request for the opening message of a study; the key is
+    (study, model, hash of the request), so it changes with any setting of the request."""
+
+    api_kwargs = ContextManager(api, study=study).prepare(
+        get_api_kwargs(initial_messages(study, api), study)
+    )
+    request = json.dumps(api_kwargs, sort_keys=True).encode()
+    key = (
+        getattr(study, "name", "default"),
+        study.MODEL,
+        hashlib.sha256(request).hexdigest(),
+    )
+    return key, api_kwargs
+
+
+class OpeningCache:
+    """Opening messages by request key, generated in a background thread per key.
+
+    A newer version of a study replaces the opening of the previous version. Failed
+    generations are retried after `retry_interval` seconds.
+    """
+
+    def __init__(self, retry_interval=60.0):
+        self.retry_interval = retry_interval
+        self.openings = {}
+        self.pending = set()
+        # Key -> time of the last failed generation
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            return self.openings.get(key)
+
+    def put(self, key, message, study):
+        """Store an opening (unless it is empty or contains a closing code)."""
+
+        codes = tuple(study.CLOSING_MESSAGES.keys())
+        if not message.strip() or get_code_automaton(codes).find(message) is not None:
+            return
+        with self.lock:
+            for other in list(self.openings):
+                if other[0] == key[0] and other != key:
+                    del self.openings[other]
+            self.openings.setdefault(key, message)
+
+    def warm(self, study, client, api):
+        """Generate the opening of a study in the background unless it is cached."""
+
+        key, api_kwargs = opening_request(study, api)
+        with self.lock:
+            if (
+                key in self.openings
+                or key in self.pending
+                or time.monotonic() - self.failed.get(key, float("-inf"))
+                < self.retry_interval
+            ):
+                return
+            self.pending.add(key)
+
+        threading.Thread(
+            target=self.generate,
+            args=(key, api_kwargs, study, client, api),
+            name="opening-prefetch",
+            daemon=True,
+        ).start()
+
+    def generate(self, key, api_kwargs, study, client, api):
+        try:
+            message = "".join(stream_reply(client, api, api_kwargs, lambda usage: None))
+            self.put(key, message, study)
+            logger.info(f"Prefetched opening message of study {key[0]} ({key[1]})")
+        except Exception:
+            logger.exception(f"Prefetching the opening message of study {key[0]} failed")
+            with self.lock:
+                self.failed[key] = time.monotonic()
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+
+@once_per_process
+def get_opening_cache():
+    """Cache of opening messages shared by all sessions of the process."""
+
+    return OpeningCache()
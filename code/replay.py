@@ -0,0 +1,390 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import config
+from resources import get_api, get_api_kwargs, get_async_client
+from streaming import stream_reply
+from context import ContextManager, summary_api_kwargs
+from codes import get_code_automaton
+from storage import read_journal, write_atomic
+from export import parse_transcript
+from mock_provider import MockProvider, content_text, start_mock_provider
+from benchmark import percentiles
+
+
+# Offline replay of recorded interviews: the respondent messages of recorded transcripts
+# are sent again through the code paths of interview.py (context manager, scheduler and
+# streaming engine) with a different model, system prompt or temperature, e.g.
+# `python replay.py ../data/transcripts/ ../data/replay/ --model gpt-4o-mini`
+# Responses of the API are cached by request, so repeated runs are free; with `--provider
+# mock` or `--provider recorded` the replay runs fully offline against mock_provider.py
+# (without the cache)
+
+
+class ResponseCache:
+    """Responses (text and token usage) in SQLite, keyed by a hash of the request."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.execute(
+                """CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    usage TEXT
+                )"""
+            )
+
+    @staticmethod
+    def key(api_kwargs, provider):
+        """Hash of the provider (base URL of the API), the model and the messages of a
+        request (with system prompt, temperature and max tokens, as they also change the
+        response)."""
+
+        request = {
+            name: api_kwargs[name]
+            for name in ("model", "system", "messages", "temperature", "max_tokens")
+            if name in api_kwargs
+        }
+        request["provider"] = provider
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT text, usage FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1]) if row[1] else None
+
+    def put(self, key, model, text, usage):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, model, text, json.dumps(usage) if usage else None),
+            )
+
+
+def load_transcripts(directory, limit=None):
+    """Load final transcripts (lossless JSONL, otherwise parsed text) by username."""
+
+    transcripts = {}
+    for name in sorted(os.listdir(directory)):
+        username, extension = os.path.splitext(name)
+        path = os.path.join(directory, name)
+        if name.startswith(".") or username in transcripts:
+            continue
+        if extension == ".jsonl" or (
+            extension == ".txt"
+            and not os.path.exists(os.path.join(directory, f"{username}.jsonl"))
+        ):
+            if extension == ".jsonl":
+                transcripts[username] = read_journal(path)
+            else:
+                with open(path, "r", encoding="utf-8") as f:
+                    transcripts[username] = parse_transcript(f.read())
+        if limit is not None and len(transcripts) >= limit:
+            break
+    return transcripts
+
+
+def recorded_turns(messages):
+    """Split a recorded transcript into its opening message and the respondent messages
+    with the recorded interviewer reply to each of them."""
+
+    opening = None
+    turns = []
+    for message in messages:
+        if message["role"] == "assistant":
+            if opening is None:
+                opening = message["content"]
+            elif turns and turns[-1][1] is None:
+                turns[-1][1] = message["content"]
+        elif message["role"] == "user" and opening is not None:
+            turns.append([message["content"], None])
+    return opening, turns
+
+
+def recorded_replies(transcripts):
+    """Reply function for the mock provider which answers with the recorded interviewer
+    message that followed the same respondent messages (offline identity replay)."""
+
+    replies = {}
+    for messages in transcripts.values():
+        opening, turns = recorded_turns(messages)
+        answers = []
+        replies.setdefault((), opening)
+        for answer, reply in turns:
+            answers.append(answer)
+            if reply is not None:
+                replies.setdefault(tuple(answers), reply)
+
+    def reply(messages, system):
+        answers = tuple(
+            content_text(message["content"])
+            for message in messages
+            if message["role"] == "user"
+        )
+        # The first message of Anthropic interviews is a fixed "Hi"
+        if get_api() == "anthropic":
+            answers = answers[1:]
+        return replies.get(answers, "")
+
+    return reply
+
+
+class Replayer:
+    """Replays interviews one turn at a time like interview.py does for a respondent."""
+
+    def __init__(self, api_key, cache=None):
+        self.api = get_api()
+        self.client = get_async_client(api_key)
+        # Responses of different endpoints (e.g. a proxy) are cached separately
+        self.provider = str(self.client.base_url)
+        self.cache = cache
+        self.automaton = get_code_automaton(tuple(config.CLOSING_MESSAGES.keys()))
+
+    def generate(self, context, messages):
+        """Next interviewer message (from the cache or streamed); returns the text and
+        the measurements of the turn."""
+
+        def summarize(messages, previous_summary):
+            return "".join(
+                stream_reply(
+                    self.client,
+                    self.api,
+                    summary_api_kwargs(messages, previous_summary),
+                    record_usage=lambda usage: None,
+                )
+            )
+
+        api_kwargs = context.prepare(get_api_kwargs(messages), summarize=summarize)
+        key = self.cache.key(api_kwargs, self.provider) if self.cache else None
+        cached = self.cache.get(key) if self.cache else None
+        if cached is not None:
+            text, usage = cached
+            return text, {"cached": True, "usage": usage}
+
+        if self.api == "openai":
+            record_usage = context.record_openai_usage
+        elif self.api == "anthropic":
+            record_usage = context.record_anthropic_usage
+
+        usage_count = len(context.usage)
+        start = time.perf_counter()
+        first_token = None
+        text = ""
+        for text_delta in stream_reply(self.client, self.api, api_kwargs, record_usage):
+            if first_token is None:
+                first_token = time.perf_counter() - start
+            text += text_delta
+        latency = time.perf_counter() - start
+
+        usage = context.usage[-1] if len(context.usage) > usage_count else None
+        if self.cache:
+            self.cache.put(key, api_kwargs["model"], text, usage)
+        return text, {
+            "cached": False,
+            "usage": usage,
+            "latency": latency,
+            "time_to_first_token": first_token,
+        }
+
+    def replay(self, username, recorded):
+        """Replay one recorded interview; returns one row per turn."""
+
+        opening, turns = recorded_turns(recorded)
+        context = ContextManager(self.api, config.CONTEXT_TOKEN_BUDGET)
+        if self.api == "openai":
+            messages = [{"role": "system", "content": config.SYSTEM_PROMPT}]
+        elif self.api == "anthropic":
+            messages = [{"role": "user", "content": "Hi"}]
+
+        rows = []
+        for turn, (answer, recorded_reply) in enumerate([(None, opening)] + turns):
+            if answer is not None:
+                messages.append({"role": "user", "content": answer})
+            text, measurements = self.generate(context, messages)
+            messages.append({"role": "assistant", "content": text})
+            code = self.automaton.find(text)
+            rows.append(
+                {
+                    "username": username,
+                    "turn": turn,
+                    "respondent": answer,
+                    "recorded": recorded_reply,
+                    "replayed": text,
+                    "code": code,
+                    **measurements,
+                }
+            )
+            # The replayed interview ends at a closing code like in interview.py
+            if code is not None:
+                break
+        return rows
+
+
+def format_side_by_side(rows):
+    """Text of a replayed interview with the recorded and replayed interviewer messages."""
+
+    text = ""
+    for row in rows:
+        if row["respondent"] is not None:
+            text += f"respondent: {row['respondent']}\n\n"
+        text += f"recorded interviewer: {row['recorded']}\n\n"
+        text += f"replayed interviewer: {row['replayed']}\n\n"
+        text += "-" * 80 + "\n\n"
+    return text
+
+
+def run_replay(
+    transcripts_directory,
+    output_directory,
+    api_key,
+    concurrency=10,
+    cache_path=None,
+    limit=None,
+):
+    """Replay all transcripts of a directory concurrently; writes side-by-side transcripts,
+    one JSON line per turn and a report (which is also returned)."""
+
+    transcripts = load_transcripts(transcripts_directory, limit)
+    cache = ResponseCache(cache_path) if cache_path else None
+    replayer = Replayer(api_key, cache)
+    os.makedirs(output_directory, exist_ok=True)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = dict(
+            zip(
+                transcripts,
+                executor.map(replayer.replay, transcripts, transcripts.values()),
+            )
+        )
+    wall_time = time.perf_counter() - start
+
+    for username, rows in results.items():
+        write_atomic(
+            os.path.join(output_directory, f"{username}.txt"), format_side_by_side(rows)
+        )
+    rows = [row for user_rows in results.values() for row in user_rows]
+    write_atomic(
+        os.path.join(output_directory, "turns.jsonl"),
+        "".join(json.dumps(row) + "\n" for row in rows),
+    )
+
+    streamed = [row for row in rows if not row["cached"]]
+    usage = [row["usage"] for row in streamed if row["usage"]]
+    report = {
+        "settings": {
+            "model": config.MODEL,
+            "temperature": config.TEMPERATURE,
+            "system_prompt_sha256": hashlib.sha256(
+                config.SYSTEM_PROMPT.encode()
+            ).hexdigest(),
+            "concurrency": concurrency,
+        },
+        "interviews": len(results),
+        "turns": len(rows),
+        "completed_interviews": sum(
+            any(row["code"] for row in user_rows) for user_rows in results.values()
+        ),
+        "cache": {"hits": len(rows) - len(streamed), "misses": len(streamed)},
+        "wall_time": wall_time,
+        "turn_latency": percentiles([row["latency"] for row in streamed]),
+        "time_to_first_token": percentiles(
+            [row["time_to_first_token"] for row in streamed if row["time_to_first_token"]]
+        ),
+        "tokens": {
+            key: sum(turn[key] for turn in usage)
+            for key in ("input_tokens", "output_tokens", "cached_input_tokens")
+        },
+        "reply_characters": {
+            "recorded": percentiles(
+                [len(row["recorded"]) for row in rows if row["recorded"] is not None]
+            ),
+            "replayed": percentiles([len(row["replayed"]) for row in rows]),
+        },
+    }
+    write_atomic(
+        os.path.join(output_directory, "report.json"), json.dumps(report, indent=2)
+    )
+    return report
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Replay recorded interviews with a different model or configuration."
+    )
+    parser.add_argument("transcripts", help="Directory with final transcripts.")
+    parser.add_argument("output", help="Directory for side-by-side transcripts and report.")
+    parser.add_argument("--model", help="Model (default from config).")
+    parser.add_argument("--temperature", type=float, help="Temperature (default from config).")
+    parser.add_argument("--system-prompt", help="File with the system prompt to replay with.")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--limit", type=int, help="Replay only the first N transcripts.")
+    parser.add_argument(
+        "--cache",
+        default="../data/replay_cache.db",
+        help="Response cache of API runs ('' to disable).",
+    )
+    parser.add_argument(
+        "--provider",
+        choices=["api", "mock", "recorded"],
+        default="api",
+        help="Real API (key from OPENAI_API_KEY/ANTHROPIC_API_KEY), mock replies, or the "
+        "recorded interviewer messages served by the mock provider.",
+    )
+    parser.add_argument("--first-token-latency", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=float, default=1000.0)
+    args = parser.parse_args()
+
+    # Configuration has to be changed before the (cached) API and API kwargs are determined
+    if args.model:
+        config.MODEL = args.model
+    if args.temperature is not None:
+        config.TEMPERATURE = args.temperature
+    if args.system_prompt:
+        with open(args.system_prompt, "r", encoding="utf-8") as f:
+            config.SYSTEM_PROMPT = f.read()
+
+    if args.provider == "api":
+        api_key = os.environ[
+            "OPENAI_API_KEY" if get_api() == "openai" else "ANTHROPIC_API_KEY"
+        ]
+    else:
+        replies = None
+        if args.provider == "recorded":
+            replies = recorded_replies(load_transcripts(args.transcripts, args.limit))
+        server, url = start_mock_provider(
+            MockProvider(
+                args.first_token_latency, args.tokens_per_second, replies=replies
+            )
+        )
+        os.environ["OPENAI_BASE_URL"] = f"{url}/v1"
+        os.environ["ANTHROPIC_BASE_URL"] = url
+        api_key = "mock"
+
+    report = run_replay(
+        args.transcripts,
+        args.output,
+        api_key,
+        concurrency=args.concurrency,
+        # Replies of the mock provider are not cached (they are free and not responses of
+        # the model)
+        cache_path=args.cache if args.provider == "api" and args.cache else None,
+        limit=args.limit,
+    )
+    print(json.dumps(report, indent=2))
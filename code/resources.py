@@ -0,0 +1,206 @@
+import os
+import asyncio
+import threading
+from functools import lru_cache, wraps
+import config
+from scheduler import Scheduler
+
+
+# Process-wide resources which Streamlit would otherwise recreate on every rerun of
+# interview.py: API client with pooled keep-alive HTTP connections, directories and
+# API keyword arguments
+
+
+class ConnectionStats:
+    """Counts requests and newly opened connections of the shared HTTP client."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    async def on_request(self, request):
+        """httpx request hook which attaches a trace callback to the request."""
+
+        request.extensions["trace"] = self.trace
+        with self.lock:
+            self.requests += 1
+
+    async def trace(self, event_name, info):
+        """httpcore trace callback; only a new connection opens a TCP socket."""
+
+        if event_name == "connection.connect_tcp.started":
+            with self.lock:
+                self.new_connections += 1
+
+    def summary(self):
+        with self.lock:
+            requests, new_connections = self.requests, self.new_connections
+        return {
+            "requests": requests,
+            "new_connections": new_connections,
+            "reused_connections": max(requests - new_connections, 0),
+            "reuse_rate": (
+                max(requests - new_connections, 0) / requests if requests else 0.0
+            ),
+        }
+
+
+connection_stats = ConnectionStats()
+
+
+def once_per_process(function):
+    """Cache a resource like lru_cache, but create it only once even if several sessions
+    ask for it at the same time (e.g. two event loops would break the shared client)."""
+
+    cached = lru_cache(maxsize=None)(function)
+    lock = threading.Lock()
+
+    @wraps(function)
+    def get(*args):
+        with lock:
+            return cached(*args)
+
+    return get
+
+
+def once_per_study(function):
+    """Cache a function of a study (and further arguments) like lru_cache, but keep only
+    the result of the current version of each study: a study reloaded by the registry
+    replaces the results of its previous version instead of adding to them."""
+
+    cache = {}
+    lock = threading.Lock()
+
+    @wraps(function)
+    def get(study=config, *args):
+        key = (getattr(study, "name", None),) + args
+        with lock:
+            entry = cache.get(key)
+        if entry is not None and entry[0] is study:
+            return entry[1]
+        value = function(study, *args)
+        with lock:
+            cache[key] = (study, value)
+        return value
+
+    return get
+
+
+def api_of_model(model):
+    """Determine the API from a model name."""
+
+    if "gpt" in model.lower():
+        return "openai"
+    elif "claude" in model.lower():
+        return "anthropic"
+    else:
+        raise ValueError(
+            "Model does not contain 'gpt' or 'claude'; unable to determine API."
+        )
+
+
+@lru_cache(maxsize=None)
+def get_api():
+    """Determine the API from the model name in config.py."""
+
+    return api_of_model(config.MODEL)
+
+
+def http_limits():
+    import httpx
+
+    return httpx.Limits(
+        max_connections=config.MAX_CONNECTIONS,
+        max_keepalive_connections=config.MAX_CONNECTIONS,
+        keepalive_expiry=config.KEEPALIVE_EXPIRY,
+    )
+
+
+@once_per_process
+def get_event_loop():
+    """Start one event loop in a background thread which runs all API streams of the
+    process, so that the async client and its connection pool stay on one loop."""
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="api-event-loop", daemon=True).start()
+    return loop
+
+
+@once_per_process
+def get_async_client(api_key, api=None):
+    """Create the async API client (of the API of config.py by default) and its pooled
+    HTTP transport once per process (retries are left to the scheduler)."""
+
+    event_hooks = {"request": [connection_stats.on_request]}
+    api = api or get_api()
+
+    if api == "openai":
+        from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+        return AsyncOpenAI(
+            api_key=api_key,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(
+                limits=http_limits(), event_hooks=event_hooks
+            ),
+        )
+
+    elif api == "anthropic":
+        import anthropic
+
+        return anthropic.AsyncAnthropic(
+            api_key=api_key,
+            max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(
+                limits=http_limits(), event_hooks=event_hooks
+            ),
+        )
+
+
+@once_per_process
+def get_scheduler():
+    """Scheduler shared by the API requests of all sessions of the process."""
+
+    if config.FALLBACK_MODEL and get_api() != api_of_model(config.FALLBACK_MODEL):
+        raise ValueError("FALLBACK_MODEL has to use the same API as MODEL.")
+    return Scheduler()
+
+
+@once_per_study
+def setup_directories(study=config):
+    """Create directories of a study (config.py by default) if they do not already exist
+    (once per version of the study)."""
+
+    if config.STORAGE_BACKEND == "files":
+        for directory in (
+            study.TRANSCRIPTS_DIRECTORY,
+            study.TIMES_DIRECTORY,
+            study.BACKUPS_DIRECTORY,
+        ):
+            os.makedirs(directory, exist_ok=True)
+    os.makedirs(study.LOCKS_DIRECTORY, exist_ok=True)
+
+
+@once_per_study
+def base_api_kwargs(study=config):
+    """API kwargs which are the same for all sessions of a study (config.py by default)."""
+
+    if api_of_model(study.MODEL) == "openai":
+        # Final chunk of the stream reports token usage
+        api_kwargs = {"stream": True, "stream_options": {"include_usage": True}}
+    elif api_of_model(study.MODEL) == "anthropic":
+        api_kwargs = {"system": study.SYSTEM_PROMPT}
+
+    api_kwargs["model"] = study.MODEL
+    api_kwargs["max_tokens"] = study.MAX_OUTPUT_TOKENS
+    if study.TEMPERATURE is not None:
+        api_kwargs["temperature"] = study.TEMPERATURE
+
+    return api_kwargs
+
+
+def get_api_kwargs(messages, study=config):
+    """API kwargs for one session (copy, as the cached dict is shared across sessions)."""
+
+    return {**base_api_kwargs(study), "messages": messages}
@@ -0,0 +1,201 @@
+import asyncio
+import random
+import time
+from collections import deque
+import config
+
+
+# HTTP status codes after which a request is retried (529: Anthropic overloaded)
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at `rate_per_minute` (None for no limit)."""
+
+    def __init__(self, rate_per_minute):
+        self.rate_per_minute = rate_per_minute
+        self.tokens = rate_per_minute or 0
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.rate_per_minute,
+            self.tokens + (now - self.updated) * self.rate_per_minute / 60,
+        )
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` tokens are available (0 if available now)."""
+
+        if self.rate_per_minute is None:
+            return 0.0
+        self.refill()
+        amount = min(amount, self.rate_per_minute)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.rate_per_minute
+
+    def take(self, amount):
+        # Can become negative when actual usage exceeds the estimate
+        if self.rate_per_minute is not None:
+            self.tokens -= amount
+
+
+def retry_delay(error):
+    """Minimum seconds to wait before retrying after an error, or None if the error is
+    not retryable (works with the errors of both SDKs and of mock providers)."""
+
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return 0.0
+    if getattr(error, "status_code", None) in RETRY_STATUS_CODES:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return float(retry_after) if retry_after is not None else 0.0
+        except ValueError:
+            return 0.0
+    return None
+
+
+class Scheduler:
+    """Schedules the API requests of all sessions of a process on its event loop.
+
+    Requests wait for the rate limits of their model (requests and tokens per minute)
+    and for a free slot of the concurrency limit. Retryable errors before the first
+    streamed delta are retried with jittered exponential backoff; once the retries are
+    exhausted, the request falls back to the fallback model if one is configured.
+    """
+
+    def __init__(
+        self,
+        rate_limits=None,
+        max_concurrent_requests=None,
+        max_retries=None,
+        retry_base_delay=None,
+        fallback_model=None,
+    ):
+        self.rate_limits = config.RATE_LIMITS if rate_limits is None else rate_limits
+        self.max_concurrent_requests = (
+            config.MAX_CONCURRENT_REQUESTS
+            if max_concurrent_requests is None
+            else max_concurrent_requests
+        )
+        self.max_retries = config.MAX_RETRIES if max_retries is None else max_retries
+        self.retry_base_delay = (
+            config.RETRY_BASE_DELAY if retry_base_delay is None else retry_base_delay
+        )
+        self.fallback_model = (
+            config.FALLBACK_MODEL if fallback_model is None else fallback_model
+        )
+        self.buckets = {}
+        self.semaphore = None
+
+        # Metrics
+        self.queued = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.retries = 0
+        self.fallbacks = 0
+        self.failures = 0
+        self.wait_times = deque(maxlen=1000)
+
+    def model_buckets(self, model):
+        if model not in self.buckets:
+            limits = self.rate_limits.get(model, {})
+            self.buckets[model] = (
+                TokenBucket(limits.get("requests_per_minute")),
+                TokenBucket(limits.get("tokens_per_minute")),
+            )
+        return self.buckets[model]
+
+    async def acquire(self, model, tokens):
+        """Wait until the rate limits of the model allow the request."""
+
+        requests_bucket, tokens_bucket = self.model_buckets(model)
+        while True:
+            wait = max(requests_bucket.wait_time(1), tokens_bucket.wait_time(tokens))
+            if wait == 0:
+                requests_bucket.take(1)
+                tokens_bucket.take(tokens)
+                return
+            await asyncio.sleep(wait)
+
+    def record_usage(self, model, estimated_tokens, used_tokens):
+        """Correct the token bucket of a model by the actual token usage."""
+
+        self.model_buckets(model)[1].take(used_tokens - estimated_tokens)
+
+    async def run(self, api_kwargs, stream, emit, estimated_tokens=0):
+        """Run a streamed request; `stream(api_kwargs)` is an async iterator of deltas
+        which are passed to `emit`. Returns the model which produced the reply."""
+
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent_requests)
+
+        models = [api_kwargs["model"]]
+        if self.fallback_model and self.fallback_model != api_kwargs["model"]:
+            models.append(self.fallback_model)
+
+        self.requests += 1
+        for model_index, model in enumerate(models):
+            if model_index > 0:
+                self.fallbacks += 1
+
+            for attempt in range(self.max_retries + 1):
+                emitted = False
+
+                # Wait for rate limits and a free slot
+                self.queued += 1
+                start = time.monotonic()
+                try:
+                    await self.acquire(model, estimated_tokens)
+                    await self.semaphore.acquire()
+                finally:
+                    self.queued -= 1
+                self.wait_times.append(time.monotonic() - start)
+
+                self.in_flight += 1
+                try:
+                    async for delta in stream({**api_kwargs, "model": model}):
+                        emitted = True
+                        emit(delta)
+                    return model
+
+                except Exception as e:
+                    delay = retry_delay(e)
+                    # Text already displayed cannot be retracted, so no retry after that
+                    if emitted or delay is None:
+                        self.failures += 1
+                        raise
+                    last_error = e
+
+                finally:
+                    self.in_flight -= 1
+                    self.semaphore.release()
+
+                if attempt < self.max_retries:
+                    self.retries += 1
+                    backoff = self.retry_base_delay * 2**attempt
+                    await asyncio.sleep(max(delay, random.uniform(0, backoff)))
+
+        self.failures += 1
+        raise last_error
+
+    def metrics(self):
+        """Queue depth, requests in flight, counters and wait times (seconds)."""
+
+        wait_times = sorted(self.wait_times)
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "failures": self.failures,
+            "wait_time_mean": sum(wait_times) / len(wait_times) if wait_times else 0.0,
+            "wait_time_p95": (
+                wait_times[int(0.95 * (len(wait_times) - 1))] if wait_times else 0.0
+            ),
+            "wait_time_max": wait_times[-1] if wait_times else 0.0,
+        }
@@ -0,0 +1,224 @@
+import sys
+import time
+import weakref
+import logging
+import threading
+import config
+from resources import once_per_process
+
+
+logger = logging.getLogger(__name__)
+
+
+class Message:
+    """One message of an interview with the dict access used throughout the app
+    (`message["role"]`, `message.get("code")`).
+
+    Roles are interned and contents are not copied, so e.g. the system message of all
+    OpenAI sessions of a study refers to the one string of its system prompt.
+    """
+
+    __slots__ = ("role", "content", "code")
+
+    def __init__(self, role, content, code=None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.code = code
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+
+class MessageHistory:
+    """Messages of one session of which only the most recent ones are kept in memory.
+
+    Messages before index `spilled` are already stored and were released from memory;
+    they are read again with `load` (from the journal or the database) when an older
+    part of the history is accessed, so messages which are needed with every rerun
+    should not be released (see `spill` and `restore`). Indexing, slicing, len and
+    iteration work as for the full list of messages.
+    """
+
+    __slots__ = (
+        "recent",
+        "spilled",
+        "stored",
+        "load",
+        "last_active",
+        "lock",
+        "__weakref__",
+    )
+
+    def __init__(self, load=None, spilled=0):
+        self.recent = []
+        self.spilled = spilled
+        # Number of messages which are stored (only these can be released)
+        self.stored = spilled
+        self.load = load
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.spilled + len(self.recent)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        with self.lock:
+            spilled, recent = self.spilled, list(self.recent)
+
+        if isinstance(index, slice):
+            positions = range(*index.indices(spilled + len(recent)))
+            if positions and min(positions[0], positions[-1]) < spilled:
+                messages = self.load_spilled(spilled) + recent
+                return [messages[position] for position in positions]
+            return [recent[position - spilled] for position in positions]
+
+        if index < 0:
+            index += spilled + len(recent)
+        if index < 0 or index >= spilled + len(recent):
+            raise IndexError("message index out of range")
+        if index < spilled:
+            return self.load_spilled(spilled)[index]
+        return recent[index - spilled]
+
+    def load_spilled(self, spilled):
+        """Read the first `spilled` messages back from storage."""
+
+        messages = self.load()[:spilled]
+        if len(messages) < spilled:
+            raise RuntimeError(
+                f"Only {len(messages)} of {spilled} stored messages could be read"
+            )
+        return [
+            Message(message["role"], message["content"], message.get("code"))
+            for message in messages
+        ]
+
+    def append(self, message):
+        if not isinstance(message, Message):
+            message = Message(**message)
+        with self.lock:
+            self.recent.append(message)
+
+    def copy(self):
+        """Snapshot which shares the released part (e.g. for saves in other threads)."""
+
+        with self.lock:
+            history = MessageHistory(self.load, self.spilled)
+            history.recent = list(self.recent)
+            history.stored = self.stored
+        return history
+
+    def spill(self, keep, needed=None):
+        """Release stored messages from memory, except the `keep` most recent ones and
+        those from index `needed` on (e.g. the history still sent to the API)."""
+
+        if self.load is None:
+            return
+        with self.lock:
+            upto = min(self.stored, len(self) - keep)
+            if needed is not None:
+                upto = min(upto, needed)
+            cut = upto - self.spilled
+            if cut > 0:
+                del self.recent[:cut]
+                self.spilled += cut
+
+    def restore(self, start):
+        """Read released messages from index `start` on back into memory (e.g. when an
+        idle session continues), so that they are not read again with every access."""
+
+        with self.lock:
+            spilled = self.spilled
+        if start >= spilled:
+            return
+        messages = self.load_spilled(spilled)[start:]
+        with self.lock:
+            if self.spilled == spilled:
+                self.recent[:0] = messages
+                self.spilled = start
+
+    def memory(self):
+        """Approximate bytes of the messages held in memory (without the shared system
+        prompt)."""
+
+        with self.lock:
+            recent = list(self.recent)
+        size = sys.getsizeof(recent)
+        for message in recent:
+            size += sys.getsizeof(message)
+            if message.role != "system":
+                size += sys.getsizeof(message.content)
+        return size
+
+
+class SessionRegistry:
+    """Process-wide weak registry of the message histories of all sessions.
+
+    Sessions without activity for `idle_timeout` seconds release all stored messages
+    (they are read back if the respondent continues). Sessions which Streamlit expires
+    disappear from the registry with their session state.
+    """
+
+    def __init__(self, idle_timeout, sweep_interval=60.0):
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.histories = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+    def register(self, history):
+        with self.lock:
+            self.histories.add(history)
+
+    def touch(self, history):
+        """Record activity of a session and evict idle sessions (at most once per
+        sweep interval)."""
+
+        history.last_active = time.monotonic()
+        if (
+            self.idle_timeout is not None
+            and history.last_active - self.last_sweep >= self.sweep_interval
+        ):
+            self.last_sweep = history.last_active
+            self.evict_idle()
+
+    def evict_idle(self):
+        now = time.monotonic()
+        with self.lock:
+            histories = list(self.histories)
+        evicted = 0
+        for history in histories:
+            if now - history.last_active > self.idle_timeout and history.recent:
+                spilled = history.spilled
+                history.spill(0)
+                evicted += history.spilled > spilled
+        if evicted:
+            logger.info(f"Evicted {evicted} idle sessions, memory: {self.report()}")
+
+    def report(self):
+        """Sessions, messages in memory and released, and bytes of messages in memory."""
+
+        with self.lock:
+            histories = list(self.histories)
+        return {
+            "sessions": len(histories),
+            "resident_messages": sum(len(history.recent) for history in histories),
+            "spilled_messages": sum(history.spilled for history in histories),
+            "resident_bytes": sum(history.memory() for history in histories),
+        }
+
+
+@once_per_process
+def get_session_registry():
+    """Create the registry of sessions once per process."""
+
+    return SessionRegistry(config.SESSION_IDLE_TIMEOUT)
@@ -0,0 +1,603 @@
+import os
+import json
+import time
+import queue
+import logging
+import sqlite3
+import tempfile
+import threading
+import argparse
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # No locks between processes on Windows
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# Format of session ids (the start time of the session)
+SESSION_ID_FORMAT = "%Y_%m_%d_%H_%M_%S"
+
+
+class SessionTakenOver(Exception):
+    """Raised when a session stores data after a newer session claimed its username."""
+
+
+def format_transcript(messages):
+    """Return a list of messages as transcript text in 'role: content' lines."""
+
+    return "".join(f"{message['role']}: {message['content']}\n" for message in messages)
+
+
+def message_fields(message):
+    """Stored fields of a message: role, content and the closing code it contains (only
+    messages with a code carry it)."""
+
+    fields = {"role": message["role"], "content": message["content"]}
+    if message.get("code"):
+        fields["code"] = message.get("code")
+    return fields
+
+
+def format_messages(messages):
+    """Return a list of messages as lossless JSONL (one line per message with its
+    position; multi-line contents stay within their line)."""
+
+    return "".join(
+        json.dumps({"position": position, **message_fields(message)}) + "\n"
+        for position, message in enumerate(messages)
+    )
+
+
+def format_time(start_time, end_time):
+    """Return the text of a time file with start time and duration of an interview."""
+
+    duration = (end_time - start_time) / 60
+    return f"Start time (UTC): {time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(start_time))}\nInterview duration (minutes): {duration:.2f}"
+
+
+def write_atomic(path, text):
+    """Write a file atomically: temporary file in the same directory, fsync, rename."""
+
+    directory = os.path.dirname(path) or "."
+    fd, temporary_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+
+    # Persist the rename itself (directories cannot be opened on Windows)
+    if os.name == "posix":
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+
+def read_journal(path):
+    """Read a JSONL journal and return its list of messages (skipping a torn last line).
+
+    Lines carry the position of their message, so messages appended again by a retried
+    write are only returned once.
+    """
+
+    messages = {}
+    with open(path, "r", encoding="utf-8") as j:
+        for line in j:
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash or failed write can leave an incomplete line
+                continue
+            messages[message.get("position", len(messages))] = message
+    return [messages[position] for position in sorted(messages)]
+
+
+def commit(save, *args, attempts=3, delay=0.05, **kwargs):
+    """Call a save function and retry it with bounded exponential backoff."""
+
+    for attempt in range(attempts):
+        try:
+            return save(*args, **kwargs)
+        except (OSError, sqlite3.Error):
+            if attempt == attempts - 1:
+                raise
+            time.sleep(delay * 2**attempt)
+
+
+class SpillWriter:
+    """Background thread which keeps retrying saves that failed repeatedly.
+
+    Saves are queued in memory, so the script thread never waits for a failing disk.
+    Usernames with a queued final save count as completed in the meantime.
+    """
+
+    def __init__(self, max_delay=30.0):
+        self.max_delay = max_delay
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        threading.Thread(target=self.drain, name="spill-writer", daemon=True).start()
+
+    def submit(self, username, save, *args, **kwargs):
+        with self.lock:
+            self.pending.add(username)
+        self.queue.put((username, save, args, kwargs))
+
+    def is_pending(self, username):
+        with self.lock:
+            return username in self.pending
+
+    def drain(self):
+        while True:
+            username, save, args, kwargs = self.queue.get()
+            delay = 0.5
+            while True:
+                try:
+                    save(*args, **kwargs)
+                    break
+                except SessionTakenOver:
+                    logger.warning(f"Spilled save for {username} dropped, session taken over")
+                    break
+                except Exception:
+                    logger.exception(f"Spilled save for {username} failed, retrying")
+                    time.sleep(delay)
+                    delay = min(2 * delay, self.max_delay)
+            with self.lock:
+                self.pending.discard(username)
+
+
+class SessionClaims:
+    """Coordinates which session (on any worker) runs the interview of a username.
+
+    Each username has a lock file and an owner file in a shared directory. The newest
+    session to log in claims the username, and saves of older sessions are refused, so
+    two workers never store data of the same respondent. Locks are advisory `flock`
+    locks which the OS releases if a worker crashes.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    @contextmanager
+    def locked(self, username):
+        """Hold the exclusive lock of a username."""
+
+        with open(os.path.join(self.directory, f"{username}.lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def owner(self, username):
+        """Token of the session which currently runs the interview (or None)."""
+
+        try:
+            with open(os.path.join(self.directory, f"{username}.owner")) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def claim(self, username, token):
+        """Make a session the owner of a username (call while holding the lock)."""
+
+        write_atomic(os.path.join(self.directory, f"{username}.owner"), token)
+
+    def guard(self, username, token, save):
+        """Wrap a save function so that it only stores data while the session owns the
+        username (checked and written under the lock)."""
+
+        def guarded_save(*args, **kwargs):
+            with self.locked(username):
+                if self.owner(username) != token:
+                    raise SessionTakenOver(username)
+                return save(*args, **kwargs)
+
+        return guarded_save
+
+
+class FileStorage:
+    """Default storage: transcripts, times and backups as files in three directories."""
+
+    def __init__(
+        self, transcripts_directory, times_directory, backups_directory, journal=True
+    ):
+        self.transcripts_directory = transcripts_directory
+        self.times_directory = times_directory
+        self.backups_directory = backups_directory
+        self.journal = journal
+        # Only journals can be read back message by message (see load_messages)
+        self.stores_messages = journal
+        # Journals whose last write failed and may end with an incomplete line
+        self.torn_journals = set()
+
+    def journal_path(self, username, session_id):
+        return os.path.join(
+            self.backups_directory, f"{username}_journal_started_{session_id}.jsonl"
+        )
+
+    def interview_completed(self, username):
+        """Check if the time file exists which signals that the interview was completed."""
+
+        return os.path.exists(os.path.join(self.times_directory, f"{username}.txt"))
+
+    def load_messages(self, username, session_id):
+        """Read the stored messages of a session from its journal."""
+
+        return read_journal(self.journal_path(username, session_id))
+
+    def latest_session(self, username):
+        """Session id and start time of the latest session of a user with a journal."""
+
+        if not self.journal:
+            return None
+
+        prefix = f"{username}_journal_started_"
+        session_ids = [
+            name[len(prefix) : -len(".jsonl")]
+            for name in os.listdir(self.backups_directory)
+            if name.startswith(prefix) and name.endswith(".jsonl")
+        ]
+        if not session_ids:
+            return None
+
+        # Session ids are start times which sort chronologically
+        session_id = max(session_ids)
+        return session_id, time.mktime(time.strptime(session_id, SESSION_ID_FORMAT))
+
+    def append_to_journal(self, username, session_id, messages, start=0):
+        """Append messages (starting at position `start` of the session) to the
+        append-only JSONL journal of the session as one batch."""
+
+        if not messages:
+            return
+
+        path = self.journal_path(username, session_id)
+        try:
+            self.write_journal_lines(path, messages, start)
+        except BaseException:
+            self.torn_journals.add(path)
+            raise
+        self.torn_journals.discard(path)
+
+    def write_journal_lines(self, path, messages, start):
+        """Write all new messages and fsync once."""
+
+        with open(path, "a", encoding="utf-8") as j:
+            # Start on a new line after an incomplete line of a failed write
+            if path in self.torn_journals:
+                j.write("\n")
+            now = time.time()
+            for position, message in enumerate(messages, start=start):
+                j.write(
+                    json.dumps(
+                        {"position": position, **message_fields(message), "time": now}
+                    )
+                    + "\n"
+                )
+            j.flush()
+            os.fsync(j.fileno())
+
+    def save_backup(self, username, session_id, messages, start_time, stored=0):
+        """Store interview progress; only messages after index `stored` are new."""
+
+        if self.journal:
+            self.append_to_journal(username, session_id, messages[stored:], stored)
+            return
+
+        # Otherwise rewrite the full backup files
+        write_atomic(
+            os.path.join(
+                self.backups_directory, f"{username}_transcript_started_{session_id}.txt"
+            ),
+            format_transcript(messages),
+        )
+        write_atomic(
+            os.path.join(
+                self.backups_directory, f"{username}_time_started_{session_id}.txt"
+            ),
+            format_time(start_time, time.time()),
+        )
+
+    def save_final(
+        self,
+        username,
+        session_id,
+        messages,
+        start_time,
+        stored=0,
+        end_time=None,
+        metadata=None,
+    ):
+        """Store final transcript and time files (compacting the journal if used), and
+        the session metadata (e.g. per-turn metrics) as JSON next to the time file."""
+
+        if self.journal:
+            # Make sure the journal contains all messages of the session
+            self.append_to_journal(username, session_id, messages[stored:], stored)
+            messages = read_journal(self.journal_path(username, session_id))
+
+        # Time file last, as its existence signals a completed interview
+        write_atomic(
+            os.path.join(self.transcripts_directory, f"{username}.txt"),
+            format_transcript(messages),
+        )
+        write_atomic(
+            os.path.join(self.transcripts_directory, f"{username}.jsonl"),
+            format_messages(messages),
+        )
+        if metadata is not None:
+            write_atomic(
+                os.path.join(self.times_directory, f"{username}.json"),
+                json.dumps(metadata),
+            )
+        write_atomic(
+            os.path.join(self.times_directory, f"{username}.txt"),
+            format_time(start_time, end_time or time.time()),
+        )
+
+
+class SQLiteDatabase:
+    """SQLite database in WAL mode (readers do not block the writer) with one connection
+    per thread, as Streamlit runs sessions in different threads."""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return self.local.connection
+
+
+class SQLiteStorage(SQLiteDatabase):
+    """Storage of all sessions and messages in one SQLite database in WAL mode."""
+
+    stores_messages = True
+
+    def __init__(self, path):
+        super().__init__(path)
+
+        connection = self.connection()
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                start_time REAL NOT NULL,
+                end_time REAL,
+                metadata TEXT,
+                PRIMARY KEY (username, session_id)
+            );
+            CREATE INDEX IF NOT EXISTS sessions_username_status
+                ON sessions (username, status);
+            CREATE TABLE IF NOT EXISTS messages (
+                username TEXT NOT NULL,
+                session_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                time REAL NOT NULL,
+                code TEXT,
+                PRIMARY KEY (username, session_id, position)
+            );
+            """
+        )
+
+        # Databases created before sessions had metadata
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(sessions)")]
+        if "metadata" not in columns:
+            connection.execute("ALTER TABLE sessions ADD COLUMN metadata TEXT")
+
+        # Databases created before messages had their closing code
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(messages)")]
+        if "code" not in columns:
+            connection.execute("ALTER TABLE messages ADD COLUMN code TEXT")
+
+    def interview_completed(self, username):
+        """Check with one indexed query whether the user has a completed session."""
+
+        row = (
+            self.connection()
+            .execute(
+                "SELECT 1 FROM sessions WHERE username = ? AND status = 'completed' LIMIT 1",
+                (username,),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    def load_messages(self, username, session_id):
+        """Read the stored messages of a session in order."""
+
+        return [
+            {"role": role, "content": content, "code": code}
+            for role, content, code in self.connection().execute(
+                """SELECT role, content, code FROM messages
+                WHERE username = ? AND session_id = ? ORDER BY position""",
+                (username, session_id),
+            )
+        ]
+
+    def latest_session(self, username):
+        """Session id and start time of the latest active session of a user."""
+
+        return (
+            self.connection()
+            .execute(
+                """SELECT session_id, start_time FROM sessions
+                WHERE username = ? AND status = 'active'
+                ORDER BY start_time DESC LIMIT 1""",
+                (username,),
+            )
+            .fetchone()
+        )
+
+    def store(
+        self,
+        username,
+        session_id,
+        messages,
+        start_time,
+        stored,
+        status,
+        now=None,
+        metadata=None,
+    ):
+        """Insert new messages as one batch and update the session status."""
+
+        now = now or time.time()
+        metadata = json.dumps(metadata) if metadata is not None else None
+        connection = self.connection()
+        with connection:
+            connection.execute(
+                """INSERT INTO sessions
+                (username, session_id, status, start_time, end_time, metadata)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (username, session_id)
+                DO UPDATE SET status = excluded.status, end_time = excluded.end_time,
+                metadata = COALESCE(excluded.metadata, metadata)""",
+                (username, session_id, status, start_time, now, metadata),
+            )
+            connection.executemany(
+                """INSERT OR REPLACE INTO messages
+                (username, session_id, position, role, content, time, code)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                [
+                    (
+                        username,
+                        session_id,
+                        position,
+                        message["role"],
+                        message["content"],
+                        now,
+                        message.get("code"),
+                    )
+                    for position, message in enumerate(messages[stored:], start=stored)
+                ],
+            )
+
+    def save_backup(self, username, session_id, messages, start_time, stored=0):
+        """Store interview progress; only messages after index `stored` are new."""
+
+        self.store(username, session_id, messages, start_time, stored, "active")
+
+    def save_final(
+        self,
+        username,
+        session_id,
+        messages,
+        start_time,
+        stored=0,
+        end_time=None,
+        metadata=None,
+    ):
+        """Store the remaining messages and metadata, and mark the session completed."""
+
+        self.store(
+            username,
+            session_id,
+            messages,
+            start_time,
+            stored,
+            "completed",
+            end_time,
+            metadata,
+        )
+
+    def export(self, transcripts_directory, times_directory, backups_directory):
+        """Bulk export all sessions into the file layout of FileStorage."""
+
+        for directory in (transcripts_directory, times_directory, backups_directory):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+        connection = self.connection()
+        sessions = connection.execute(
+            """SELECT username, session_id, status, start_time, end_time, metadata
+            FROM sessions"""
+        ).fetchall()
+
+        for username, session_id, status, start_time, end_time, metadata in sessions:
+            messages = self.load_messages(username, session_id)
+
+            # Completed sessions become final files, all sessions are kept as backups
+            if status == "completed" and metadata is not None:
+                write_atomic(os.path.join(times_directory, f"{username}.json"), metadata)
+            if status == "completed":
+                write_atomic(
+                    os.path.join(transcripts_directory, f"{username}.jsonl"),
+                    format_messages(messages),
+                )
+                file_names = [
+                    (transcripts_directory, times_directory, f"{username}.txt", f"{username}.txt")
+                ]
+            else:
+                file_names = []
+            file_names.append(
+                (
+                    backups_directory,
+                    backups_directory,
+                    f"{username}_transcript_started_{session_id}.txt",
+                    f"{username}_time_started_{session_id}.txt",
+                )
+            )
+
+            for transcript_dir, time_dir, transcript_name, time_name in file_names:
+                write_atomic(
+                    os.path.join(transcript_dir, transcript_name),
+                    format_transcript(messages),
+                )
+                write_atomic(
+                    os.path.join(time_dir, time_name), format_time(start_time, end_time)
+                )
+
+        return len(sessions)
+
+
+if __name__ == "__main__":
+
+    # Bulk export of a SQLite database, e.g. `python storage.py export ../data/export/`
+    parser = argparse.ArgumentParser(description="Interview storage tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser(
+        "export", help="Export a SQLite database into transcript and time files."
+    )
+    export_parser.add_argument("output", help="Directory for the exported files.")
+    export_parser.add_argument("--database", help="SQLite database (default from config).")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        import config
+
+        storage = SQLiteStorage(args.database or config.SQLITE_DATABASE)
+        n = storage.export(
+            os.path.join(args.output, "transcripts"),
+            os.path.join(args.output, "times"),
+            os.path.join(args.output, "backups"),
+        )
+        print(f"Exported {n} sessions to {args.output}")
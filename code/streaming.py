@@ -0,0 +1,150 @@
+import asyncio
+import queue
+import time
+import config
+from resources import get_event_loop, get_scheduler
+from context import estimate_input_tokens
+
+
+# Marker which ends the queue of text deltas
+END_OF_STREAM = object()
+
+
+async def produce_deltas(client, api, api_kwargs, deltas, record_usage):
+    """Stream a reply through the scheduler and put its text deltas into the queue."""
+
+    scheduler = get_scheduler()
+    estimated_tokens = estimate_input_tokens(api_kwargs)
+
+    async def stream(api_kwargs):
+        if api == "openai":
+            response = await client.chat.completions.create(**api_kwargs)
+            async for chunk in response:
+                if chunk.usage is not None:
+                    record_usage(chunk.usage)
+                    scheduler.record_usage(
+                        api_kwargs["model"], estimated_tokens, chunk.usage.total_tokens
+                    )
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    yield chunk.choices[0].delta.content
+
+        elif api == "anthropic":
+            async with client.messages.stream(**api_kwargs) as response:
+                async for text_delta in response.text_stream:
+                    if text_delta is not None:
+                        yield text_delta
+                usage = (await response.get_final_message()).usage
+                record_usage(usage)
+                scheduler.record_usage(
+                    api_kwargs["model"],
+                    estimated_tokens,
+                    usage.input_tokens + usage.output_tokens,
+                )
+
+    try:
+        await scheduler.run(api_kwargs, stream, deltas.put, estimated_tokens)
+
+    except Exception as e:
+        # Raised again in the script thread
+        deltas.put(e)
+
+    finally:
+        deltas.put(END_OF_STREAM)
+
+
+def stream_reply(client, api, api_kwargs, record_usage):
+    """Yield batches of text deltas of a reply while it is streamed on the event loop.
+
+    The request runs through the scheduler on the process-wide event loop and does not
+    block other sessions. All deltas which arrived since the last iteration are joined
+    into one batch, so a slow consumer (e.g. throttled repaints) receives fewer, larger
+    batches.
+    """
+
+    deltas = queue.Queue()
+    future = asyncio.run_coroutine_threadsafe(
+        produce_deltas(client, api, api_kwargs, deltas, record_usage), get_event_loop()
+    )
+
+    try:
+        finished = False
+        while not finished:
+            batch = [deltas.get()]
+            while True:
+                try:
+                    batch.append(deltas.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch[-1] is END_OF_STREAM:
+                batch.pop()
+                finished = True
+            for item in batch:
+                if isinstance(item, Exception):
+                    raise item
+
+            text = "".join(batch)
+            if text:
+                yield text
+
+    finally:
+        # Stop the request if the consumer stops early (e.g. after a closing code)
+        if not future.done():
+            future.cancel()
+
+
+class ThrottledMarkdown:
+    """Displays a growing message in a placeholder with a limited number of repaints.
+
+    The placeholder is repainted at most every `interval` seconds and only once at least
+    `min_chars` new characters have arrived. Completed paragraphs are written once into
+    their own element, so each repaint only re-sends the paragraph still in progress.
+    """
+
+    def __init__(self, placeholder, interval=None, min_chars=None):
+        self.placeholder = placeholder
+        self.interval = config.STREAM_REPAINT_INTERVAL if interval is None else interval
+        self.min_chars = config.STREAM_REPAINT_MIN_CHARS if min_chars is None else min_chars
+        self.container = None
+        self.paragraphs = []
+        self.current = None
+        self.last_paint = 0.0
+        self.painted_length = 0
+
+    def update(self, text):
+        """Repaint with the text so far if the repaint limits allow it."""
+
+        if (
+            time.monotonic() - self.last_paint < self.interval
+            or len(text) - self.painted_length < self.min_chars
+        ):
+            return
+        self.paint(text)
+
+    def paint(self, text):
+        if self.container is None:
+            self.container = self.placeholder.container()
+
+        # Write paragraphs that are complete now, each only once
+        *complete, in_progress = text.split("\n\n")
+        for paragraph in complete[len(self.paragraphs) :]:
+            if self.current is None:
+                self.current = self.container.empty()
+            self.current.markdown(paragraph)
+            self.paragraphs.append(paragraph)
+            self.current = None
+
+        if self.current is None:
+            self.current = self.container.empty()
+        self.current.markdown(in_progress + "▌")
+
+        self.last_paint = time.monotonic()
+        self.painted_length = len(text)
+
+    def finish(self, text):
+        """Display the complete message as one element."""
+
+        self.placeholder.markdown(text)
+
+    def clear(self):
+        self.placeholder.empty()
@@ -0,0 +1,254 @@
+import os
+import re
+import sys
+import time
+import runpy
+import logging
+import argparse
+import threading
+from functools import lru_cache
+import config
+from resources import api_of_model
+from codes import get_code_automaton
+
+
+logger = logging.getLogger(__name__)
+
+
+# Several studies served by one app: each study is a Python file `<name>.py` in
+# STUDIES_DIRECTORY which sets the study settings below like config.py (all settings it
+# does not set are taken from config.py), selected with the URL parameter `?study=<name>`.
+# Studies are validated and compiled once, and reloaded when their file changes.
+
+
+# Settings which each study can set (all other settings are shared and set in config.py)
+STUDY_SETTINGS = (
+    "INTERVIEW_OUTLINE",
+    "GENERAL_INSTRUCTIONS",
+    "CODES",
+    "CLOSING_MESSAGES",
+    "SYSTEM_PROMPT",
+    "MODEL",
+    "TEMPERATURE",
+    "MAX_OUTPUT_TOKENS",
+    "CONTEXT_TOKEN_BUDGET",
+    "SECTIONS",
+    "TRANSCRIPTS_DIRECTORY",
+    "TIMES_DIRECTORY",
+    "BACKUPS_DIRECTORY",
+    "SQLITE_DATABASE",
+    "LOCKS_DIRECTORY",
+)
+
+# Data of a study is stored in a subdirectory (or database) of its own by default
+DATA_DIRECTORIES = (
+    "TRANSCRIPTS_DIRECTORY",
+    "TIMES_DIRECTORY",
+    "BACKUPS_DIRECTORY",
+    "LOCKS_DIRECTORY",
+)
+
+STUDY_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def compose_system_prompt(interview_outline, general_instructions, codes):
+    """System prompt from its parts (as in config.py)."""
+
+    return f"""{interview_outline}
+
+
+{general_instructions}
+
+
+{codes}"""
+
+
+class Study:
+    """Validated settings of one study, with the names of config.py (so that config.py
+    itself can be used wherever a study is expected)."""
+
+    def __init__(self, name, settings):
+        self.name = name
+        for key in STUDY_SETTINGS:
+            setattr(self, key, settings[key])
+        self.validate()
+
+        # Compile the detector of closing codes once
+        get_code_automaton(tuple(self.CLOSING_MESSAGES.keys()))
+
+    def validate(self):
+        """Raise a ValueError which lists all invalid settings."""
+
+        errors = []
+        for key in ("INTERVIEW_OUTLINE", "SYSTEM_PROMPT"):
+            if not isinstance(getattr(self, key), str) or not getattr(self, key).strip():
+                errors.append(f"{key} has to be a non-empty string")
+
+        if not isinstance(self.CLOSING_MESSAGES, dict) or not self.CLOSING_MESSAGES:
+            errors.append("CLOSING_MESSAGES has to be a non-empty dictionary")
+        else:
+            for code, message in self.CLOSING_MESSAGES.items():
+                if not isinstance(code, str) or not code or not isinstance(message, str):
+                    errors.append(f"CLOSING_MESSAGES has an invalid entry for {code!r}")
+                elif isinstance(self.SYSTEM_PROMPT, str) and code not in self.SYSTEM_PROMPT:
+                    errors.append(f"code {code!r} does not appear in the system prompt")
+
+        try:
+            api = api_of_model(self.MODEL)
+            if config.FALLBACK_MODEL and api != api_of_model(config.FALLBACK_MODEL):
+                errors.append("FALLBACK_MODEL has to use the same API as MODEL")
+        except (ValueError, AttributeError) as e:
+            errors.append(f"MODEL: {e}")
+
+        if self.TEMPERATURE is not None and not (
+            isinstance(self.TEMPERATURE, (int, float)) and 0 <= self.TEMPERATURE <= 2
+        ):
+            errors.append("TEMPERATURE has to be None or a number between 0 and 2")
+        for key in ("MAX_OUTPUT_TOKENS", "CONTEXT_TOKEN_BUDGET"):
+            value = getattr(self, key)
+            if (value is not None or key == "MAX_OUTPUT_TOKENS") and not (
+                isinstance(value, int) and value > 0
+            ):
+                errors.append(f"{key} has to be a positive integer")
+
+        if not isinstance(self.SECTIONS, dict):
+            errors.append("SECTIONS has to be a dictionary")
+        for key in DATA_DIRECTORIES + ("SQLITE_DATABASE",):
+            if not isinstance(getattr(self, key), str):
+                errors.append(f"{key} has to be a path")
+
+        if errors:
+            raise ValueError(f"Study '{self.name}': " + "; ".join(errors))
+
+
+def load_study(name, path):
+    """Run a study file with the settings of config.py as defaults and validate it."""
+
+    defaults = {key: getattr(config, key) for key in STUDY_SETTINGS}
+    del defaults["SYSTEM_PROMPT"]
+    for key in DATA_DIRECTORIES:
+        defaults[key] = os.path.join(getattr(config, key), name, "")
+    root, extension = os.path.splitext(config.SQLITE_DATABASE)
+    defaults["SQLITE_DATABASE"] = f"{root}_{name}{extension}"
+
+    settings = runpy.run_path(path, init_globals=defaults)
+    if "SYSTEM_PROMPT" not in settings:
+        settings["SYSTEM_PROMPT"] = compose_system_prompt(
+            settings["INTERVIEW_OUTLINE"],
+            settings["GENERAL_INSTRUCTIONS"],
+            settings["CODES"],
+        )
+    return Study(name, settings)
+
+
+class StudyRegistry:
+    """Studies of a directory, loaded on first use and reloaded when their file changes.
+
+    The file of a study is checked at most every `check_interval` seconds. If a changed
+    file is invalid, the previous version of the study stays in use; an invalid new study
+    raises the same ValueError until its file changes (it is not run again before).
+    """
+
+    def __init__(self, directory, check_interval=2.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self.default = Study("default", vars(config))
+        # Name -> (mtime, size, time of last check, study or error of an invalid study)
+        self.studies = {}
+        self.lock = threading.Lock()
+
+    def names(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            name[: -len(".py")]
+            for name in os.listdir(self.directory)
+            if name.endswith(".py") and STUDY_NAME.match(name[: -len(".py")])
+        )
+
+    def get(self, name=None):
+        """Return a study (the settings of config.py if no name is given); raises a
+        KeyError for unknown studies and a ValueError for invalid ones."""
+
+        study = self.lookup(name)
+        if isinstance(study, ValueError):
+            raise ValueError(*study.args)
+        return study
+
+    def lookup(self, name):
+        """Study of a name, or the ValueError of an invalid study (both cached per
+        version of the file)."""
+
+        if not name:
+            return self.default
+        if not STUDY_NAME.match(name):
+            raise KeyError(name)
+
+        with self.lock:
+            entry = self.studies.get(name)
+            now = time.monotonic()
+            if entry is not None and now - entry[2] < self.check_interval:
+                return entry[3]
+
+            path = os.path.join(self.directory, f"{name}.py")
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                self.studies.pop(name, None)
+                raise KeyError(name)
+
+            unchanged = entry is not None and (entry[0], entry[1]) == (
+                stat.st_mtime_ns,
+                stat.st_size,
+            )
+            if unchanged:
+                self.studies[name] = (entry[0], entry[1], now, entry[3])
+                return entry[3]
+
+            try:
+                study = load_study(name, path)
+            except Exception as e:
+                if entry is None or isinstance(entry[3], ValueError):
+                    # Remembered for this version of the file, so that it is not run
+                    # again with every request
+                    logger.exception(f"Loading study {name} failed")
+                    if isinstance(e, ValueError):
+                        study = e
+                    else:
+                        study = ValueError(f"Study '{name}': {type(e).__name__}: {e}")
+                else:
+                    logger.exception(
+                        f"Reloading study {name} failed, using previous version"
+                    )
+                    study = entry[3]
+            else:
+                if entry is not None and not isinstance(entry[3], ValueError):
+                    logger.info(f"Reloaded study {name}")
+            self.studies[name] = (stat.st_mtime_ns, stat.st_size, now, study)
+            return study
+
+
+@lru_cache(maxsize=None)
+def get_study_registry():
+    """Create the registry of studies once per process."""
+
+    return StudyRegistry(config.STUDIES_DIRECTORY)
+
+
+if __name__ == "__main__":
+
+    # Validate all study files, e.g. before deploying `python studies.py`
+    parser = argparse.ArgumentParser(description="Validate the study files.")
+    parser.add_argument("--directory", default=config.STUDIES_DIRECTORY)
+    args = parser.parse_args()
+
+    registry = StudyRegistry(args.directory)
+    valid = True
+    for name in registry.names():
+        try:
+            study = registry.get(name)
+            print(f"{name}: ok ({study.MODEL}, data in {study.TRANSCRIPTS_DIRECTORY})")
+        except Exception as e:
+            print(f"{name}: {e}")
+            valid = False
+    sys.exit(0 if valid else 1)
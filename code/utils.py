@@ -1,7 +1,26 @@
 import streamlit as st
 import hmac
 import time
-import os
+import uuid
+import logging
+from functools import partial
+import config
+from storage import (
+    FileStorage,
+    SQLiteStorage,
+    SessionClaims,
+    SessionTakenOver,
+    SpillWriter,
+    SESSION_ID_FORMAT,
+    commit,
+)
+from auth import CredentialStore, LoginRateLimiter
+from index import SessionIndex
+from session import Message, MessageHistory, get_session_registry
+from metrics import section_of
+
+
+logger = logging.getLogger(__name__)
 
 
 # Password screen for dashboard (note: only very basic authentication!)
@@ -18,13 +37,22 @@ def check_password():
 
     def password_entered():
         """Checks whether username and password entered by the user are correct."""
-        if st.session_state.username in st.secrets.passwords and hmac.compare_digest(
-            st.session_state.password,
-            st.secrets.passwords[st.session_state.username],
+        username = st.session_state.username
+        limiter = get_login_limiter()
+        if limiter.blocked(username):
+            st.session_state.login_blocked = True
+            st.session_state.password_correct = False
+
+        elif verify_credentials(
+            username, st.session_state.password, hash_unknown=not limiter.saturated()
         ):
+            limiter.reset(username)
+            st.session_state.login_blocked = False
             st.session_state.password_correct = True
 
         else:
+            limiter.record_failure(username)
+            st.session_state.login_blocked = False
             st.session_state.password_correct = False
 
         del st.session_state.password  # don't store password in session state
@@ -35,55 +63,307 @@ def check_password():
 
     # Otherwise show login screen
     login_form()
-    if "password_correct" in st.session_state:
+    if st.session_state.get("login_blocked", False):
+        st.error("Too many failed logins, please try again later")
+    elif "password_correct" in st.session_state:
         st.error("User or password incorrect")
     return False, st.session_state.username
 
 
-def check_if_interview_completed(directory, username):
-    """Check if interview transcript/time file exists which signals that interview was completed."""
+def verify_credentials(username, password, hash_unknown=True):
+    """Check a username and password against the credentials backend of config.py
+    (`hash_unknown=False` skips the dummy hash of unknown usernames of the "sqlite"
+    backend)."""
 
-    # Test account has multiple interview attempts
+    if config.CREDENTIALS_BACKEND == "secrets":
+        return username in st.secrets.passwords and hmac.compare_digest(
+            password, st.secrets.passwords[username]
+        )
+    elif config.CREDENTIALS_BACKEND == "sqlite":
+        return get_credential_store().verify(username, password, hash_unknown)
+    else:
+        raise ValueError("CREDENTIALS_BACKEND must be 'secrets' or 'sqlite'.")
+
+
+@st.cache_resource
+def get_credential_store():
+    """Open the credentials database once per process (respondents are looked up on
+    login, so startup does not depend on the number of respondents)."""
+
+    return CredentialStore(config.CREDENTIALS_DATABASE)
+
+
+@st.cache_resource
+def get_login_limiter():
+    """Return the limiter of failed logins shared by all sessions of the process."""
+
+    return LoginRateLimiter(
+        config.LOGIN_ATTEMPTS, config.LOGIN_ATTEMPTS_WINDOW, config.LOGIN_ATTEMPTS_TOTAL
+    )
+
+
+def get_storage():
+    """Return the storage backend selected in config.py with the directories (or the
+    database) of the study of the session."""
+
+    study = st.session_state.get("study", config)
+    if config.STORAGE_BACKEND == "sqlite":
+        return open_sqlite_storage(study.SQLITE_DATABASE)
+    elif config.STORAGE_BACKEND == "files":
+        return open_file_storage(
+            study.TRANSCRIPTS_DIRECTORY, study.TIMES_DIRECTORY, study.BACKUPS_DIRECTORY
+        )
+    else:
+        raise ValueError("STORAGE_BACKEND must be 'files' or 'sqlite'.")
+
+
+@st.cache_resource
+def open_sqlite_storage(path):
+    """Return the storage of one SQLite database (created once per process)."""
+
+    return SQLiteStorage(path)
+
+
+@st.cache_resource
+def open_file_storage(transcripts_directory, times_directory, backups_directory):
+    """Return the storage of one set of directories (created once per process)."""
+
+    return FileStorage(
+        transcripts_directory,
+        times_directory,
+        backups_directory,
+        journal=config.JOURNAL_BACKUPS,
+    )
+
+
+@st.cache_resource
+def get_spill_writer():
+    """Return the background writer for saves that keep failing (one per process)."""
+
+    return SpillWriter()
+
+
+def get_claims():
+    """Return the lock files of the study of the session which coordinate sessions
+    across workers."""
+
+    return open_claims(st.session_state.get("study", config).LOCKS_DIRECTORY)
+
+
+@st.cache_resource
+def open_claims(directory):
+    return SessionClaims(directory)
+
+
+def new_message_history(username, session_id, messages=()):
+    """Message history of a session (with its already stored messages); older stored
+    messages are released from memory if the storage backend can read them back."""
+
+    storage = get_storage()
+    load = None
+    if config.SESSION_MESSAGE_WINDOW is not None and storage.stores_messages:
+        load = partial(storage.load_messages, username, session_id)
+
+    if load is not None:
+        history = MessageHistory(load, spilled=len(messages))
+    else:
+        history = MessageHistory()
+        for message in messages:
+            history.append(
+                Message(message["role"], message["content"], message.get("code"))
+            )
+        history.stored = len(messages)
+
+    get_session_registry().register(history)
+    return history
+
+
+def start_session(username):
+    """Start a new session, or resume the latest unfinished session of the user from
+    storage (messages, start time and section of the interview)."""
+
+    storage = get_storage()
+    st.session_state.session_token = uuid.uuid4().hex
+    latest = None
+
+    # Test account has multiple interview attempts and is not coordinated
     if username != "testaccount":
+        claims = get_claims()
+        with claims.locked(username):
+            if config.RESUME_SESSIONS and not storage.interview_completed(username):
+                latest = storage.latest_session(username)
+            # From now on, saves of earlier sessions of the user are refused
+            claims.claim(username, st.session_state.session_token)
+
+    messages = []
+    if latest is not None:
+        session_id, start_time = latest
+        messages = storage.load_messages(username, session_id)
+        # Continue after the last interviewer message (a respondent message without
+        # reply is answered again)
+        while messages and messages[-1]["role"] != "assistant":
+            messages.pop()
+
+    if messages:
+        logger.info(f"Resuming session {session_id} of {username}")
+        for message in messages:
+            if message["role"] == "assistant":
+                st.session_state.section = section_of(
+                    message["content"],
+                    st.session_state.section,
+                    st.session_state.study.SECTIONS,
+                )
+    else:
+        start_time = time.time()
+        session_id = time.strftime(SESSION_ID_FORMAT, time.localtime(start_time))
+
+    st.session_state.start_time = start_time
+    st.session_state.start_time_file_names = session_id
+    st.session_state.messages = new_message_history(username, session_id, messages)
+
+
+def owns_session(username):
+    """Check whether no newer session (e.g. in another window or on another worker)
+    took over the interview of the user."""
 
-        # Check if file exists
-        try:
-            with open(os.path.join(directory, f"{username}.txt"), "r") as _:
-                return True
+    if username == "testaccount":
+        return True
+    return get_claims().owner(username) == st.session_state.session_token
 
-        except FileNotFoundError:
-            return False
+
+def check_if_interview_completed(username):
+    """Check with the storage backend whether the interview was completed."""
+
+    # Test account has multiple interview attempts
+    if username != "testaccount":
+
+        # A final save still waiting in the spill queue also counts as completed
+        if get_spill_writer().is_pending(username):
+            return True
+        return get_storage().interview_completed(username)
 
     else:
 
         return False
 
 
-def save_interview_data(
-    username,
-    transcripts_directory,
-    times_directory,
-    file_name_addition_transcript="",
-    file_name_addition_time="",
-):
-    """Write interview data (transcript and time) to disk."""
-
-    # Store chat transcript
-    with open(
-        os.path.join(
-            transcripts_directory, f"{username}{file_name_addition_transcript}.txt"
-        ),
-        "w",
-    ) as t:
-        for message in st.session_state.messages:
-            t.write(f"{message['role']}: {message['content']}\n")
-
-    # Store file with start time and duration of interview
-    with open(
-        os.path.join(times_directory, f"{username}{file_name_addition_time}.txt"),
-        "w",
-    ) as d:
-        duration = (time.time() - st.session_state.start_time) / 60
-        d.write(
-            f"Start time (UTC): {time.strftime('%d/%m/%Y %H:%M:%S', time.localtime(st.session_state.start_time))}\nInterview duration (minutes): {duration:.2f}"
+@st.cache_resource
+def get_session_index():
+    """Open the index of sessions for the admin dashboard once per process."""
+
+    return SessionIndex(config.INDEX_DATABASE)
+
+
+def index_session(username, end_time=None):
+    """Update the row of the session and the metrics of its new turns in the index of
+    the admin dashboard (errors are logged and do not stop the interview)."""
+
+    history = st.session_state.messages
+    turn_metrics = st.session_state.get("turn_metrics", [])
+    indexed = st.session_state.get("indexed_turns", 0)
+    code = None
+    if end_time is not None:
+        for message in history[-2:]:
+            code = message.get("code") or code
+
+    try:
+        get_session_index().update(
+            st.session_state.study.name,
+            username,
+            st.session_state.start_time_file_names,
+            st.session_state.start_time,
+            len(history),
+            st.session_state.get("section"),
+            st.session_state.study.MODEL,
+            turn_metrics[indexed:],
+            end_time=end_time,
+            code=code,
+        )
+        st.session_state.indexed_turns = len(turn_metrics)
+    except Exception:
+        logger.exception(f"Updating the session index for {username} failed")
+
+
+def session_metadata():
+    """Metadata of the session stored with the final transcript."""
+
+    return {
+        "session_id": st.session_state.start_time_file_names,
+        "study": st.session_state.study.name,
+        "model": st.session_state.study.MODEL,
+        "turns": st.session_state.get("turn_metrics", []),
+        "token_usage": st.session_state.context.usage_totals(),
+    }
+
+
+def save_interview_data(username, final=False):
+    """Store interview data (transcript and time) as backup or as final version.
+
+    Writes are retried a few times; a final save which still fails is handed to the
+    background spill writer, and a failed backup is repeated with the next backup.
+    """
+
+    storage = get_storage()
+    save_backup, save_final = storage.save_backup, storage.save_final
+    if username != "testaccount":
+        # Only store data while this session owns the interview of the user
+        claims = get_claims()
+        token = st.session_state.session_token
+        save_backup = claims.guard(username, token, save_backup)
+        save_final = claims.guard(username, token, save_final)
+
+    history = st.session_state.messages
+    messages = history.copy()
+    stored = messages.stored
+    args = (
+        username,
+        st.session_state.start_time_file_names,
+        messages,
+        st.session_state.start_time,
+    )
+
+    try:
+        if final:
+            end_time = time.time()
+            metadata = session_metadata()
+            commit(
+                save_final,
+                *args,
+                stored=stored,
+                end_time=end_time,
+                metadata=metadata,
+                attempts=config.SAVE_ATTEMPTS,
+            )
+        else:
+            commit(save_backup, *args, stored=stored, attempts=config.SAVE_ATTEMPTS)
+
+    except SessionTakenOver:
+        logger.warning(f"Session of {username} was taken over, data not stored")
+        st.session_state.interview_active = False
+        return
+
+    except Exception:
+        if final:
+            logger.exception(f"Final save for {username} failed, moved to spill queue")
+            get_spill_writer().submit(
+                username,
+                save_final,
+                *args,
+                stored=stored,
+                end_time=end_time,
+                metadata=metadata,
+            )
+        else:
+            logger.exception(f"Backup for {username} failed")
+            return
+
+    if config.INDEX_DATABASE:
+        index_session(username, end_time if final else None)
+
+    # Remember which messages are stored so that only new ones are written next time,
+    # and release stored messages outside the window which are no longer sent to the API
+    history.stored = len(messages)
+    if config.SESSION_MESSAGE_WINDOW is not None:
+        history.spill(
+            config.SESSION_MESSAGE_WINDOW, st.session_state.context.first_needed()
         )